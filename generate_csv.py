@@ -1,16 +1,20 @@
-import json
-import pandas as pd
 import csv
 import os
 from flatten_json import flatten  # Puedes instalar esto con pip install flatten_json
+from odesia_report import load_runs
 
 def flatten_json(json_data):
     flat_data = flatten(json_data, ".", root_keys_to_ignore=set(["eval_per_class"]))
     return flat_data
 
 def save_to_csv(data, file_name):
+    # las columnas son la unión de las claves de todas las filas, para que ninguna ejecución haga fallar al writer
+    fieldnames = list(dict.fromkeys(key for row in data for key in row))
+    for extra_field in ['model_config.hf_parameters.gradient_accumulation_steps', 'evaluation.val.eval_f1_per_class.non-propaganda', 'evaluation.test.eval_f1_per_class.non-propaganda', 'evaluation.test.eval_f1_per_class.propaganda', 'evaluation.val.eval_f1_per_class.propaganda']:
+        if extra_field not in fieldnames:
+            fieldnames.append(extra_field)
     with open(file_name, mode='w', newline='', encoding='utf-8') as file:
-        writer = csv.DictWriter(file, fieldnames=list(data[0].keys())+['model_config.hf_parameters.gradient_accumulation_steps', 'evaluation.val.eval_f1_per_class.non-propaganda', 'evaluation.test.eval_f1_per_class.non-propaganda', 'evaluation.test.eval_f1_per_class.propaganda', 'evaluation.val.eval_f1_per_class.propaganda'])
+        writer = csv.DictWriter(file, fieldnames=fieldnames)
         writer.writeheader()
         writer.writerows(data)
 
@@ -23,8 +27,11 @@ def process_data(data):
         processed_data.append({"dataset": dataset, "language": language, **flat_item})
     return processed_data
 
-def generate_csv_from_report():
-    data = json.load(open('report.json'))
+def generate_csv_from_report(dataset=None, language=None):
+    # Si se indica dataset e idioma solo se regenera su csv, leyendo únicamente sus filas del ledger
+    # (pandas se importa aquí para que importar el módulo sea rápido)
+    import pandas as pd
+    data = load_runs(dataset=dataset, language=language)
     processed_data = process_data(data)
 
     # Creamos un diccionario para almacenar los datos agrupados por "dataset" e "idioma"
@@ -44,4 +51,4 @@ def generate_csv_from_report():
         df.to_csv(file_name)
 
 
-    print("CSVs generados con éxito.")
\ No newline at end of file
+    print("CSVs generados con éxito.")
@@ -2,7 +2,15 @@ import copy
 import os
 import time
 #os.environ["CUDA_VISIBLE_DEVICES"] = '1'
-from odesia_evaluate_model import odesia_benchmark
+from odesia_evaluate_model import odesia_benchmark, create_jobs, run_jobs
+
+# Número de procesos que entrenan en paralelo y GPUs que se reparten entre ellos (None = las que vea el proceso)
+WORKERS = int(os.environ.get('ODESIA_WORKERS', 1))
+# 'grid' entrena todas las combinaciones completas, 'halving' para pronto las que van perdiendo en val
+SEARCH = os.environ.get('ODESIA_SEARCH', 'grid')
+# ODESIA_QUANTIZED_INFERENCE=1 evalúa y predice también con el modelo cuantizado a int8 (solo en CPU)
+QUANTIZED_INFERENCE = os.environ.get('ODESIA_QUANTIZED_INFERENCE', '0') == '1'
+DEVICES = None
 
 
 def main():
@@ -11,10 +19,6 @@ def main():
     if not os.path.exists('csvs'):
         os.makedirs('csvs')
 
-    # Ensure report.json exists. If not, create it with an empty list
-    if not os.path.exists('./report.json'):
-        with open('report.json', 'w') as f:
-            f.write('[]')
     
     
     LARGE = ['PlanTL-GOB-ES/roberta-large-bne', 'xlm-roberta-large', 'xlm-roberta-base', 'roberta-large', 'bert-base-multilingual-cased','bert-base-cased',]
@@ -59,6 +63,35 @@ def main():
             'weight_decay': [0.1, 0.01]
         }
     
+    datasets_to_eval=[
+                    #  'dipromats_2023_t2',
+                    #  'dipromats_2023_t3',
+                    #  'exist_2023_t1_hard_hard',
+                        'exist_2023_t1_hard_soft',
+                    #  'exist_2023_t1_soft_soft',
+                    #  'exist_2023_t2_hard_hard',
+                        'exist_2023_t2_hard_soft',
+                    #  'exist_2023_t2_soft_soft',
+                    #  'exist_2023_t3_hard_hard',
+                        'exist_2023_t3_hard_soft',
+                    #  'exist_2023_t3_soft_soft',
+                ]
+
+    if WORKERS > 1:
+        # todos los (modelo, dataset, hiperparámetros) van a la misma cola para aprovechar todos los procesos
+        jobs = []
+        for language in language_models:
+            for model in language_models[language]:
+                hparams_to_search = hparams_to_search_large if model in LARGE else hparams_to_search_small
+                jobs += create_jobs(model=model, 
+                                    language=language, 
+                                    grid_search=copy.deepcopy(hparams_to_search), 
+                                    datasets_to_eval=datasets_to_eval,
+                                    search=SEARCH,
+                                    quantized_inference=QUANTIZED_INFERENCE)
+        run_jobs(jobs, workers=WORKERS, devices=DEVICES)
+        return
+
     total_iterations = len(language_models['es']) + len(language_models['en'])
     current_iterations = 0
     for language in language_models:
@@ -75,19 +108,9 @@ def main():
             odesia_benchmark(model=model, 
                              language=language, 
                              grid_search=hparams_to_search, 
-                             datasets_to_eval=[
-                                #  'dipromats_2023_t2',
-                                #  'dipromats_2023_t3',
-                                #  'exist_2023_t1_hard_hard',
-                                 'exist_2023_t1_hard_soft',
-                                #  'exist_2023_t1_soft_soft',
-                                #  'exist_2023_t2_hard_hard',
-                                 'exist_2023_t2_hard_soft',
-                                #  'exist_2023_t2_soft_soft',
-                                #  'exist_2023_t3_hard_hard',
-                                 'exist_2023_t3_hard_soft',
-                                #  'exist_2023_t3_soft_soft',
-                            ]
+                             datasets_to_eval=datasets_to_eval,
+                             search=SEARCH,
+                             quantized_inference=QUANTIZED_INFERENCE
             )
                       
 
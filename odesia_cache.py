@@ -0,0 +1,124 @@
+import hashlib
+import os
+import pickle
+import shutil
+from datasets import load_from_disk, concatenate_datasets
+
+# Gold statistics already computed in this process, indexed by the hash of their content
+GOLD_STATISTICS_CACHE = {}
+
+def hash_content(*content):
+    # The key changes whenever the gold labels, their ids or the metric configuration change
+    return hashlib.sha1(pickle.dumps(content, protocol=4)).hexdigest()
+
+def load_gold_statistics(key, cache_dir=None):
+    if key in GOLD_STATISTICS_CACHE:
+        return GOLD_STATISTICS_CACHE[key]
+
+    if cache_dir:
+        path = os.path.join(cache_dir, f'{key}.pkl')
+        if os.path.isfile(path):
+            with open(path, 'rb') as f:
+                GOLD_STATISTICS_CACHE[key] = pickle.load(f)
+            return GOLD_STATISTICS_CACHE[key]
+    return None
+
+def save_gold_statistics(key, statistics, cache_dir=None):
+    GOLD_STATISTICS_CACHE[key] = statistics
+
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+        path = os.path.join(cache_dir, f'{key}.pkl')
+        # Write to a temporary file first so that other processes never read a half written file
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(statistics, f, protocol=4)
+        os.replace(tmp_path, path)
+
+# Metrics of the evaluate library already loaded in this process
+METRICS_CACHE = {}
+
+def load_metric(name):
+    # evaluate.load resolves (and may download) the metric script, so each metric is loaded once per process
+    if name not in METRICS_CACHE:
+        import evaluate
+        METRICS_CACHE[name] = evaluate.load(name)
+    return METRICS_CACHE[name]
+
+# Entries of the tokenization cache loaded or saved by this process, they are never evicted by it
+TOKENIZED_SPLITS_IN_USE = set()
+
+def tokenizer_fingerprint(tokenizer):
+    # Everything that changes the token ids: vocabulary, merges, normalizers, pre-tokenizers (add_prefix_space...),
+    # special tokens and the options of the tokenizer. Paths and names are left out, so the same tokenizer
+    # downloaded under two names gets the same fingerprint
+    if getattr(tokenizer, 'is_fast', False):
+        state = tokenizer.backend_tokenizer.to_str()
+    else:
+        state = sorted(tokenizer.get_vocab().items())
+    options = sorted((name, value) for name, value in tokenizer.init_kwargs.items()
+                     if isinstance(value, (str, int, float, bool, type(None))) and not name.endswith('_file') and name != 'name_or_path')
+    return hash_content(type(tokenizer).__name__, state, options, tokenizer.model_max_length,
+                        tokenizer.padding_side, tokenizer.truncation_side)
+
+def load_tokenized_split(key, cache_dir):
+    path = os.path.join(cache_dir, key)
+    if not os.path.isdir(path):
+        return None
+    # The modification time of the entry is its last use, for the LRU eviction
+    os.utime(path)
+    TOKENIZED_SPLITS_IN_USE.add(key)
+    return load_from_disk(path)
+
+def save_tokenized_split(key, dataset, cache_dir, max_size_gb=None):
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, key)
+    # Write to a temporary folder first so that other processes never load a half written entry
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    dataset.save_to_disk(tmp_path)
+    try:
+        os.replace(tmp_path, path)
+    except OSError:
+        # Another process saved the same entry in the meantime
+        shutil.rmtree(tmp_path, ignore_errors=True)
+    TOKENIZED_SPLITS_IN_USE.add(key)
+    if max_size_gb is not None:
+        evict_tokenized_splits(cache_dir, max_size_gb)
+
+def text_hashes(texts):
+    return [hashlib.sha1(text.encode('utf-8')).hexdigest() for text in texts]
+
+def load_text_store(store_key, cache_dir):
+    # A store of tokenized texts is saved in shards, one for each batch of new texts, named <store_key>_<hash>
+    shards = []
+    if os.path.isdir(cache_dir):
+        for name in sorted(os.listdir(cache_dir)):
+            if name.startswith(store_key+'_') and not name.endswith('.tmp'):
+                shard = load_tokenized_split(name, cache_dir)
+                if shard is not None:
+                    shards.append(shard)
+    if not shards:
+        return None
+    return concatenate_datasets(shards)
+
+def save_text_shard(store_key, shard, cache_dir, max_size_gb=None):
+    save_tokenized_split(f"{store_key}_{hash_content(list(shard['text_hash']))}", shard, cache_dir, max_size_gb)
+
+def folder_size(path):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+def evict_tokenized_splits(cache_dir, max_size_gb):
+    # Removes the least recently used entries until the cache is below max_size_gb
+    entries = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if os.path.isdir(path) and not name.endswith('.tmp'):
+            entries.append((os.path.getmtime(path), folder_size(path), name, path))
+    total_size = sum(size for _, size, _, _ in entries)
+    for _, size, name, path in sorted(entries):
+        if total_size <= max_size_gb * 2**30:
+            break
+        if name in TOKENIZED_SPLITS_IN_USE:
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+        total_size -= size
@@ -1,3 +1,4 @@
+import copy
 import os
 import numpy as np
 
@@ -6,25 +7,86 @@ from datasets import ClassLabel
 from transformers import AutoModelForTokenClassification, DataCollatorForTokenClassification
 from transformers import AutoModelForSequenceClassification, DataCollatorWithPadding
 from transformers import pipeline
-from transformers import Trainer, TrainingArguments
+from transformers import Trainer
 
 from torch.nn import BCEWithLogitsLoss
 
-import evaluate
 from sklearn.metrics import f1_score, accuracy_score
 
 from odesia_core import OdesiaHFModel
+from odesia_cache import hash_content, load_gold_statistics, save_gold_statistics, load_metric
+from odesia_configs import CACHE_GOLD_STATISTICS_ON_DISK
 
 import pandas as pd
 
-from vendor.exist2023evaluation import ICM_Hard, ICM_Soft
-
-
+from vendor.exist2023evaluation import ICM_Hard_Vectorized, ICM_Soft_Vectorized
+
+
+
+
+def predicted_word_labels(predictions, word_ids, num_words, label_list):
+    # Etiqueta de cada palabra = predicción de su primer subtoken (-1 si la palabra no tiene subtokens, p. ej. por truncado).
+    # predictions y word_ids son matrices (ejemplos x subtokens), con word_ids -1 en los tokens especiales y en el padding
+    num_examples = predictions.shape[0]
+    previous_word_ids = np.concatenate((np.full((num_examples, 1), -1), word_ids[:, :-1]), axis=1)
+    rows, columns = np.nonzero((word_ids >= 0) & (word_ids != previous_word_ids))
+    word_labels = np.full((num_examples, max(num_words.max(initial=0), 1)), -1, dtype=np.int64)
+    word_labels[rows, word_ids[rows, columns]] = predictions[rows, columns]
+
+    word_labels = fill_missing_words(word_labels, label_list)
+    label_names = np.array(label_list + ['O'])
+    return [label_names[word_labels[i, :num_words[i]]].tolist() for i in range(num_examples)]
+
+def fill_missing_words(word_labels, label_list):
+    # Una palabra sin predicción va con I-X si está entre un B-X y un I-X del mismo tipo; si no, con O
+    outside = len(label_list)
+    inside_of = np.full(outside + 1, outside)
+    for label_id, label in enumerate(label_list):
+        if label.startswith('B-') and 'I-' + label[2:] in label_list:
+            inside_of[label_id] = label_list.index('I-' + label[2:])
+
+    missing = word_labels < 0
+    if not missing.any():
+        return word_labels
+    positions = np.arange(word_labels.shape[1])
+    width = word_labels.shape[1]
+    previous_word = np.maximum.accumulate(np.where(missing, -1, positions), axis=1)
+    next_word = np.minimum.accumulate(np.where(missing, width, positions)[:, ::-1], axis=1)[:, ::-1]
+    padded_labels = np.concatenate((word_labels, np.full((word_labels.shape[0], 1), outside)), axis=1)
+    rows = np.arange(word_labels.shape[0])[:, None]
+    previous_label = np.where(previous_word >= 0, padded_labels[rows, previous_word], outside)
+    next_label = padded_labels[rows, next_word]
+    previous_label[previous_label < 0] = outside
+    next_label[next_label < 0] = outside
+
+    filled = np.where(inside_of[previous_label] == next_label, next_label, outside)
+    return np.where(missing, filled, word_labels)
+
+def convert_logits(logits, problem_type):
+    if 'multi_class_classification' in problem_type:
+        predictions = np.argmax(logits, axis=-1)
+    elif 'multi_label_classification' in problem_type:
+        probs = 1 / (1 + np.exp(-logits))
+        predictions = (probs > 0.5).astype(int)
+    else:
+        raise ValueError(f"Problem type {problem_type} not supported")
+    return predictions
+
+def predicted_labels(predictions, problem_type, label_names):
+    # Nombre de la etiqueta de cada ejemplo, o la lista de sus etiquetas en multi-label
+    if 'multi_class_classification' in problem_type:
+        return label_names[predictions].tolist()
+    elif 'multi_label_classification' in problem_type:
+        rows, columns = np.nonzero(predictions)
+        split_points = np.cumsum(np.bincount(rows, minlength=len(predictions)))[:-1]
+        return [labels.tolist() for labels in np.split(label_names[columns], split_points)]
+    else:
+        raise ValueError(f"Problem type {problem_type} not supported")
 
 
 class OdesiaUniversalClassification(OdesiaHFModel):
-    def __init__(self, model_path, dataset_path, model_config, dataset_config):
-        super().__init__(model_path, dataset_path, model_config, dataset_config)
+    def __init__(self, model_path, dataset_path, model_config, dataset_config, session=None):
+        super().__init__(model_path, dataset_path, model_config, dataset_config, session)
         
         # processing labels
         self.label2id = dataset_config['label2id']
@@ -33,23 +95,27 @@ class OdesiaUniversalClassification(OdesiaHFModel):
         self.num_labels = len(dataset_config['label2id'])
 
 class OdesiaTokenClassification(OdesiaUniversalClassification):
+    # Sequences are stored without padding; DataCollatorForTokenClassification pads each batch (labels with -100)
+    tokenization_format = 'unpadded'
 
-    def __init__(self, model_path, dataset_path, model_config, dataset_config):
-        super().__init__(model_path, dataset_path, model_config, dataset_config)
+    def __init__(self, model_path, dataset_path, model_config, dataset_config, session=None):
+        super().__init__(model_path, dataset_path, model_config, dataset_config, session)
         
         # Load DataCollator
         self.data_collator = DataCollatorForTokenClassification(tokenizer=self.tokenizer)
         
         # Tokenize the dataset
         if not self.tokenized_dataset:
-            self.tokenized_dataset = self.dataset.map(self.tokenize_and_align_labels, batched=False)
-            self.tokenized_dataset.save_to_disk(self.dataset_path_tokenized)
+            with self.timer.phase('tokenization'):
+                self.tokenized_dataset = self.cached_map(self.tokenize_and_align_labels, 
+                                                         input_columns=["tokens", "ner_tags"], 
+                                                         parameters={"function": "tokenize_and_align_labels", "label2id": self.label2id})
         
         # Load model, trainer, and metrics
-        self.seqeval = evaluate.load("seqeval")
-        self.model = AutoModelForTokenClassification.from_pretrained(
+        self.seqeval = load_metric("seqeval")
+        self.model = self.load_model(lambda: AutoModelForTokenClassification.from_pretrained(
             self.model_path, num_labels=self.num_labels, id2label=self.id2label, label2id=self.label2id
-        )
+        ))
         
         self.trainer = self.load_trainer(model=self.model, 
                                          data_collator=self.data_collator, 
@@ -79,138 +145,64 @@ class OdesiaTokenClassification(OdesiaUniversalClassification):
             "accuracy": results["overall_accuracy"],
         }
 
-    def tokenize_and_align_labels(self, example, label_all_tokens=True):
-        texts = example["tokens"]
-        tags = example.get("ner_tags", None)
-        
+    def tokenize_and_align_labels(self, examples, label_all_tokens=True):
+        # Tokeniza un lote de frases sin padding. word_ids guarda la palabra de cada subtoken (-1 para los especiales)
         tokenized_inputs = self.tokenizer(
-            texts,
+            examples["tokens"],
             is_split_into_words=True,
-            padding='max_length',  # Añade padding hasta la longitud máxima
             truncation=True,
-            return_offsets_mapping=True
+            return_length=True
         )
 
-        word_ids = tokenized_inputs.word_ids()
-
-        if tags is not None:
-            raw_labels = [self.label2id.get(tag, -100) for tag in tags]
-            labels = []
-            previous_word_idx = None
-            for word_idx in word_ids:
-                if word_idx is None:
-                    labels.append(-100)
-                elif word_idx != previous_word_idx:
-                    labels.append(raw_labels[word_idx])
-                else:
-                    labels.append(raw_labels[word_idx] if label_all_tokens else -100)
-                previous_word_idx = word_idx
-            tokenized_inputs["labels"] = labels
-
-        tokenized_inputs.pop("offset_mapping")
-        tokenized_inputs["original_tokens"] = texts
-        tokenized_inputs["word_ids"] = word_ids
+        all_word_ids = []
+        all_labels = []
+        for i in range(len(examples["tokens"])):
+            word_ids = np.array([-1 if word_idx is None else word_idx for word_idx in tokenized_inputs.word_ids(i)], dtype=np.int64)
+            all_word_ids.append(word_ids.tolist())
+
+            if "ner_tags" in examples:
+                raw_labels = np.array([self.label2id.get(tag, -100) for tag in examples["ner_tags"][i]] + [-100], dtype=np.int64)
+                # el índice -1 apunta al -100 añadido al final, así los tokens especiales quedan ignorados
+                labels = raw_labels[word_ids]
+                if not label_all_tokens:
+                    previous_word_ids = np.concatenate(([-1], word_ids[:-1]))
+                    labels[(word_ids == previous_word_ids) & (word_ids >= 0)] = -100
+                all_labels.append(labels.tolist())
+
+        if "ner_tags" in examples:
+            tokenized_inputs["labels"] = all_labels
+        tokenized_inputs["word_ids"] = all_word_ids
 
         return tokenized_inputs
 
-    def predict(self, split="test", examples=30):
+    def predict(self, split="test"):
         dataset_split = self.tokenized_dataset[split]
-        dataset_subset = dataset_split#.select(range(min(len(dataset_split), examples)))
-        
-        predictions, labels, _ = self.trainer.predict(dataset_subset)
-        
+        predictions, labels, _ = self.run_prediction(split)
         predictions = np.argmax(predictions, axis=2)
-        aligned_predictions = []
-
-        for i, example in enumerate(dataset_subset):
-            tokens = example['original_tokens']
-            word_ids = example['word_ids']
-            predicted_labels = [self.label_list[p] for p in predictions[i]]
-            aligned_tokens = []
-            aligned_labels = []
-            previous_word_idx = None
-
-            for idx, word_idx in enumerate(word_ids):
-                if word_idx is None or word_idx == previous_word_idx:
-                    continue
-                aligned_tokens.append(tokens[word_idx])
-                aligned_labels.append(predicted_labels[idx])
-                previous_word_idx = word_idx
-            
-            aligned_tokens, aligned_labels = self.adjust_alignment(tokens, aligned_tokens, aligned_labels)
-
-            def list_difference(list1, list2):
-                set1 = set(list1)
-                set2 = set(list2)
-                
-                difference1 = set1 - set2  # Elementos en list1 pero no en list2
-                difference2 = set2 - set1  # Elementos en list2 pero no en list1
-                
-                return list(difference1), list(difference2)
-
-            # Verificación de longitud
-            if len(aligned_tokens) != len(tokens):
-                print(f"Error en el alineamiento: {tokens}")
-                print(f"Tokens alineados: {aligned_tokens}")
-                print(f"Etiquetas alineadas: {aligned_labels}")
-                raise ValueError(f"Mismatch in lengths: {len(tokens)} tokens vs {len(aligned_tokens)} tokens")
-
-            
-            # Verificar que las longitudes de tokens y etiquetas sean iguales
-            if len(aligned_tokens) != len(aligned_labels):
-                raise ValueError(f"Mismatch in lengths: {len(aligned_tokens)} tokens vs {len(aligned_labels)} labels")
 
-            aligned_predictions.append({
-                'id': example['id'],
-                'ner_tags': aligned_labels,
-                'tokens': aligned_tokens
-            })
+        # word_ids de todo el split en una matriz con -1 en los tokens especiales y en el padding
+        num_examples, max_length = predictions.shape
+        lengths = np.array(dataset_split['length'])
+        word_ids = np.full((num_examples, max_length), -1, dtype=np.int64)
+        word_ids[np.arange(max_length) < lengths[:, None]] = np.concatenate(dataset_split['word_ids'])
 
-        # Verificar que el número de predicciones y referencias sea igual
-        if len(aligned_predictions) != len(dataset_subset):
-            raise ValueError(f"Mismatch in number of predictions: {len(aligned_predictions)} vs references: {len(dataset_subset)}")
-
-        return aligned_predictions
-    
-    def adjust_alignment(self, tokens, aligned_tokens, aligned_labels):
-        idx_orig = 0
-        idx_aligned = 0
-        
-        while idx_orig < len(tokens) and idx_aligned < len(aligned_tokens):
-            if tokens[idx_orig] != aligned_tokens[idx_aligned]:
-                # Identificar si se está entre B-algo e I-algo
-                if idx_aligned > 0 and idx_aligned < len(aligned_labels) - 1:
-                    prev_label = aligned_labels[idx_aligned - 1]
-                    next_label = aligned_labels[idx_aligned]
-                    
-                    if prev_label.startswith('B-') and next_label.startswith('I-') and prev_label[2:] == next_label[2:]:
-                        aligned_tokens.insert(idx_aligned, tokens[idx_orig])
-                        aligned_labels.insert(idx_aligned, f'I-{prev_label[2:]}')
-                    else:
-                        aligned_tokens.insert(idx_aligned, tokens[idx_orig])
-                        aligned_labels.insert(idx_aligned, 'O')
-                else:
-                    aligned_tokens.insert(idx_aligned, tokens[idx_orig])
-                    aligned_labels.insert(idx_aligned, 'O')
-            
-            idx_orig += 1
-            idx_aligned += 1
-        
-        # Añadir los tokens y etiquetas restantes
-        while idx_orig < len(tokens):
-            aligned_tokens.append(tokens[idx_orig])
-            aligned_labels.append('O')
-            idx_orig += 1
-
-        return aligned_tokens, aligned_labels
+        tokens = dataset_split['tokens']
+        num_words = np.array([len(example_tokens) for example_tokens in tokens])
+        ner_tags = predicted_word_labels(predictions, word_ids, num_words, self.label_list)
 
+        return [{'id': example_id,
+                 'ner_tags': ner_tags[i],
+                 'tokens': tokens[i]}
+                for i, example_id in enumerate(dataset_split['id'])]
     
     
     
 class OdesiaTextClassification(OdesiaUniversalClassification):
+    # Sequences are stored without padding; DataCollatorWithPadding pads each batch to its longest member
+    tokenization_format = 'unpadded'
     
-    def __init__(self, model_path, dataset_path, model_config, dataset_config):                
-        super().__init__(model_path, dataset_path, model_config, dataset_config)
+    def __init__(self, model_path, dataset_path, model_config, dataset_config, session=None):                
+        super().__init__(model_path, dataset_path, model_config, dataset_config, session)
          # Load DataCollator
         self.data_collator = DataCollatorWithPadding(tokenizer=self.tokenizer)
         
@@ -232,15 +224,17 @@ class OdesiaTextClassification(OdesiaUniversalClassification):
         if not self.tokenized_dataset:
             if 'multi_label_classification' not in self.problem_type:
                 self.dataset = self.dataset.cast_column('label', ClassLabel(names=self.label_list))
-            self.tokenized_dataset = self.dataset.map(lambda ex: self.tokenizer(ex["text"], truncation=True, padding=True), batched=True)
-            self.tokenized_dataset.save_to_disk(self.dataset_path_tokenized)
+            with self.timer.phase('tokenization'):
+                self.tokenized_dataset = self.cached_text_map(lambda ex: self.tokenizer(ex["text"], truncation=True, return_length=True), 
+                                                              text_column="text", 
+                                                              parameters={"function": "tokenize_text", "truncation": True})
     
     def initialize_model(self):
-        self.model = AutoModelForSequenceClassification.from_pretrained(
+        self.model = self.load_model(lambda: AutoModelForSequenceClassification.from_pretrained(
             self.model_path, 
             num_labels=self.num_labels, 
             problem_type='multi_label_classification' if 'multi_label_classification' in self.problem_type else None
-        )
+        ))
 
     def setup_trainer(self):
         self.trainer = self.load_trainer(
@@ -251,14 +245,7 @@ class OdesiaTextClassification(OdesiaUniversalClassification):
         )
 
     def convert_predictions(self, pred):
-        if 'multi_class_classification' in self.problem_type:
-            predictions = np.argmax(pred.predictions, axis=-1)
-        elif 'multi_label_classification' in self.problem_type:
-            probs = 1 / (1 + np.exp(-pred.predictions))
-            predictions = (probs > 0.5).astype(int)
-        else:
-            raise ValueError(f"Problem type {self.problem_type} not supported")
-        return predictions
+        return convert_logits(pred.predictions, self.problem_type)
                 
 
     def compute_metrics(self, pred):
@@ -276,37 +263,37 @@ class OdesiaTextClassification(OdesiaUniversalClassification):
         }
 
     def predict(self, split="test"):
-        results = []
-        dataset = self.tokenized_dataset[split]
-        pred = self.trainer.predict(dataset)
+        return {split: list(self.iter_predictions(split))}
+
+    def iter_predictions(self, split="test"):
+        # Genera las predicciones una a una, para poder escribirlas a disco sin construir la lista entera
+        pred = self.run_prediction(split)
         predictions = self.convert_predictions(pred)
+        # solo se lee la columna id, sin decodificar input_ids de cada fila
+        ids = self.tokenized_dataset[split]['id']
+        label_names = np.array([self.id2label[i] for i in range(self.num_labels)], dtype=object)
 
-        for i, prediction in enumerate(predictions):
-            if 'multi_class_classification' in self.problem_type:
-                predicted_labels = self.id2label[int(prediction)]
-            elif 'multi_label_classification' in self.problem_type:
-                predicted_labels = [self.id2label[j] for j, label_id in enumerate(prediction) if label_id == 1]
-            else:
-                raise ValueError(f"Problem type {self.problem_type} not supported")
-        
-            result = {
+        for example_id, labels in zip(ids, predicted_labels(predictions, self.problem_type, label_names)):
+            yield {
                 'test_case': self.test_case,
-                'id': dataset[i]['id'],
-                'label': predicted_labels
+                'id': example_id,
+                'label': labels
             }
-            results.append(result)
-        return {split: results}
 
     
 class OdesiaTextClassificationWithDisagreements(OdesiaTextClassification):
     
-    def __init__(self, model_path, dataset_path, model_config, dataset_config):                
-        super().__init__(model_path, dataset_path, model_config, dataset_config)
+    def __init__(self, model_path, dataset_path, model_config, dataset_config, session=None):                
+        super().__init__(model_path, dataset_path, model_config, dataset_config, session)
         # Save hierarchy and task
         self.hierarchy = dataset_config.get("hierarchy", None)
         self.exist_task = dataset_config.get("exist_task", None)   
         self.training_mode = dataset_config.get("training_mode", None)
         self.eval_mode = dataset_config.get("eval_mode", None)
+        # The gold labels of each split never change, so their ICM statistics are cached by content
+        self.gold_statistics_dir = None
+        if CACHE_GOLD_STATISTICS_ON_DISK:
+            self.gold_statistics_dir = "/".join(self.dataset_path['train'].split('/')[:-1])+"/icm_gold_statistics"
     
     def tokenize_dataset(self):
         __this__ = self 
@@ -318,21 +305,22 @@ class OdesiaTextClassificationWithDisagreements(OdesiaTextClassification):
             
             if not self.tokenized_dataset:
                 # self.dataset = self.dataset.map(preprocess_labels, batched=False)  # Ensure labels are processed
-                self.tokenized_dataset = self.dataset.map(
-                    lambda ex: self.tokenizer(ex["text"], truncation=True, padding=True), 
-                    batched=True
-                )
-                self.tokenized_dataset.save_to_disk(self.dataset_path_tokenized)
+                with self.timer.phase('tokenization'):
+                    self.tokenized_dataset = self.cached_text_map(
+                        lambda ex: self.tokenizer(ex["text"], truncation=True, return_length=True), 
+                        text_column="text", 
+                        parameters={"function": "tokenize_text", "truncation": True}
+                    )
         else: # Resort to the parent class method
             super().tokenize_dataset()
     
     def initialize_model(self):
-        self.model = AutoModelForSequenceClassification.from_pretrained(
+        self.model = self.load_model(lambda: AutoModelForSequenceClassification.from_pretrained(
             self.model_path, 
             num_labels=self.num_labels,
             # Set problem type to multi_label_classification if we are using soft training mode
             problem_type='multi_label_classification' if ('multi_label_classification' in self.problem_type or self.training_mode=='soft') else None
-        )
+        ))
 
     def setup_trainer(self):
         self.trainer = self.load_trainer(
@@ -372,8 +360,7 @@ class OdesiaTextClassificationWithDisagreements(OdesiaTextClassification):
             labels_df['id'] = labels_df.index
 
             # Compute ICM_Soft (needs to be converted into pandas dataframe)
-            icm_soft = ICM_Soft(predictions_df, labels_df, self.exist_task, self.hierarchy)
-            icm_soft_result = icm_soft.evaluate()
+            icm_soft_result = self.compute_icm_soft(predictions_df, labels_df)
             ## Add results to base_metrics
             return {
                 'icm_soft': icm_soft_result
@@ -404,17 +391,12 @@ class OdesiaTextClassificationWithDisagreements(OdesiaTextClassification):
                 predictions_df['id'] = predictions_df.index
                 labels_df['id'] = labels_df.index
                 # Compute ICM_Hard (needs to be converted into pandas dataframe)
-                icm_hard =  ICM_Hard(predictions_df, labels_df, self.exist_task, self.hierarchy)
-                icm_hard_result = icm_hard.evaluate()
+                icm_hard_result = self.compute_icm_hard(predictions_df, labels_df)
                 ## Add results to base_metrics
                 base_metrics['icm_hard'] = icm_hard_result
             else:
-                # WARN: A bit hacky but...
-                # Get the dataset we are using to evaluate by comparing the size of pred.predictions to the size of all datasets in self.dataset
-                dataset_keys = list(self.dataset.keys())
-                dataset_sizes = [len(self.dataset[split]) for split in dataset_keys]
-                dataset_index = dataset_sizes.index(pred.predictions.shape[0])
-                gold_soft_labels = self.dataset[dataset_keys[dataset_index]]['soft_label']
+                split = self.get_evaluated_split(pred)
+                gold_soft_labels = self.dataset[split]['soft_label']
                 # Get the soft labels for the predictions
                 if self.exist_task == 'multi_label':
                     probs = 1 / (1 + np.exp(-pred.predictions))
@@ -436,13 +418,36 @@ class OdesiaTextClassificationWithDisagreements(OdesiaTextClassification):
                 predictions_df['id'] = predictions_df.index 
                 labels_df['id'] = labels_df.index
                 # Convert 
-                icm_soft = ICM_Soft(predictions_df, labels_df, self.exist_task, self.hierarchy)
-                icm_soft_result = icm_soft.evaluate()
+                icm_soft_result = self.compute_icm_soft(predictions_df, labels_df)
                 ## Add results to base_metrics
                 base_metrics['icm_soft'] = icm_soft_result
         
             return base_metrics
     
+    def get_evaluated_split(self, pred):
+        # WARN: A bit hacky but...
+        # Get the dataset we are using to evaluate by comparing the size of pred.predictions to the size of all datasets in self.dataset
+        dataset_keys = list(self.dataset.keys())
+        dataset_sizes = [len(self.dataset[split]) for split in dataset_keys]
+        dataset_index = dataset_sizes.index(pred.predictions.shape[0])
+        return dataset_keys[dataset_index]
+
+    def compute_icm_hard(self, predictions_df, labels_df):
+        key = hash_content('icm_hard', self.exist_task, self.hierarchy, labels_df['id'].tolist(), labels_df['value'].tolist())
+        gold_statistics = load_gold_statistics(key, self.gold_statistics_dir)
+        icm_hard = ICM_Hard_Vectorized(predictions_df, labels_df, self.exist_task, copy.deepcopy(self.hierarchy), gold_statistics=gold_statistics)
+        if gold_statistics is None:
+            save_gold_statistics(key, icm_hard.get_gold_statistics(), self.gold_statistics_dir)
+        return icm_hard.evaluate()
+
+    def compute_icm_soft(self, predictions_df, labels_df):
+        key = hash_content('icm_soft', self.exist_task, self.hierarchy, labels_df['id'].tolist(), labels_df['value'].tolist())
+        gold_statistics = load_gold_statistics(key, self.gold_statistics_dir)
+        icm_soft = ICM_Soft_Vectorized(predictions_df, labels_df, self.exist_task, copy.deepcopy(self.hierarchy), gold_statistics=gold_statistics)
+        if gold_statistics is None:
+            save_gold_statistics(key, icm_soft.get_gold_statistics(), self.gold_statistics_dir)
+        return icm_soft.evaluate()
+
     def load_trainer(self, model, tokenized_dataset, data_collator, compute_metrics_function):
         if self.training_mode == 'hard':      
             return super().load_trainer(model, tokenized_dataset, data_collator, compute_metrics_function)
@@ -457,12 +462,7 @@ class OdesiaTextClassificationWithDisagreements(OdesiaTextClassification):
                     loss = loss_fct(logits, labels.float())  # Ensure labels are float for BCEWithLogitsLoss
                     return (loss, outputs) if return_outputs else loss
                 
-            training_args = TrainingArguments(
-                output_dir=self.output_dir,
-                run_name=self.output_dir,
-                overwrite_output_dir=True,
-                **self.model_config['hf_parameters']
-            )
+            training_args = self.training_arguments()
 
             trainer = DisagreementSoftTrainer(
                 model=model,
@@ -471,6 +471,6 @@ class OdesiaTextClassificationWithDisagreements(OdesiaTextClassification):
                 eval_dataset=tokenized_dataset["val"],
                 tokenizer=self.tokenizer,
                 data_collator=data_collator,
-                compute_metrics=compute_metrics_function,
+                compute_metrics=self.timed_metrics(compute_metrics_function),
             )
             return trainer
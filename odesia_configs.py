@@ -274,6 +274,9 @@ DATASETS = [{'name' : 'dipromats_2023_t1',
 
 GENERIC_MODEL_CONFIG = {
         "output_dir" : "",
+        # Batches of examples with similar length (less padding). It changes the order of the batches,
+        # so it is off by default to keep the runs comparable with the previous ones
+        "group_by_length": False,
         "hf_parameters": {
                 'per_device_train_batch_size': 8,
                 'num_train_epochs': 5,
@@ -283,3 +286,12 @@ GENERIC_MODEL_CONFIG = {
                 'load_best_model_at_end':True}
 }
 
+# Store the ICM gold statistics of each split in datasets/<name>/icm_gold_statistics, so that they are
+# shared between processes and runs. They are always cached in memory.
+CACHE_GOLD_STATISTICS_ON_DISK = True
+
+# Content-addressed cache of the tokenized splits, shared by all the datasets and models. The key of an entry is
+# the hash of the tokenizer, the tokenization parameters and the texts (and labels) of the split, so it never
+# gets stale. The least recently used entries are removed when it grows over TOKENIZATION_CACHE_MAX_SIZE_GB.
+TOKENIZATION_CACHE_DIR = './tokenization_cache'
+TOKENIZATION_CACHE_MAX_SIZE_GB = 20
@@ -1,11 +1,15 @@
 from abc import ABC, abstractmethod
 import torch
-from transformers import TrainingArguments, Trainer
+import numpy as np
+from transformers import TrainingArguments, Trainer, set_seed
 from transformers import AutoTokenizer
-import os 
-from datasets import load_from_disk
-from datasets import load_dataset
+from datasets import load_dataset, concatenate_datasets, Dataset, DatasetDict
 import copy
+from contextlib import contextmanager
+from odesia_timing import PhaseTimer
+from odesia_cache import (hash_content, tokenizer_fingerprint, load_tokenized_split, save_tokenized_split, text_hashes,
+                          load_text_store, save_text_shard)
+from odesia_configs import TOKENIZATION_CACHE_DIR, TOKENIZATION_CACHE_MAX_SIZE_GB
  
 class OdesiaAbstractModel(ABC):
     @abstractmethod
@@ -32,11 +36,38 @@ class OdesiaAbstractModel(ABC):
     def compute_metrics(self):
         pass
 
+class OdesiaSession:
+    """
+    Resources of a (model, dataset) pair that do not change between grid points: the raw and tokenized
+    datasets, the tokenizer and a CPU copy of the initial weights. Each grid point gets a deep copy of
+    that copy instead of reading the checkpoint from disk again.
+    """
+    def __init__(self, model_path, dataset_path):
+        self.model_path = model_path
+        self.dataset_path = dataset_path
+        self.dataset = None
+        self.tokenizer = None
+        self.tokenized_dataset = None
+        self.initial_models = {}
+
+    def load_model(self, load_function, seed=42):
+        # Los pesos iniciales de la cabeza son aleatorios: se fija la semilla antes de cargarlos, así una copia
+        # de la instantánea es idéntica a cargar el modelo de nuevo con la misma semilla
+        if seed not in self.initial_models:
+            set_seed(seed)
+            self.initial_models[seed] = load_function()
+        return copy.deepcopy(self.initial_models[seed])
+
 class OdesiaHFModel(OdesiaAbstractModel):
+    # Part of the key of the tokenization cache. Subclasses change it when the stored format changes,
+    # so that old entries are not reused
+    tokenization_format = ''
 
-    def __init__(self, model_path, dataset_path, model_config, dataset_config):
+    def __init__(self, model_path, dataset_path, model_config, dataset_config, session=None):
         super().__init__(model_path, dataset_path, model_config, dataset_config)
         
+        # Time and memory of each phase (dataset load, tokenization, model init, train, evaluate, predict...)
+        self.timer = PhaseTimer()
         # Basic configs
         self.model_config = copy.deepcopy(model_config)
         self.dataset_config = copy.deepcopy(dataset_config)
@@ -45,36 +76,126 @@ class OdesiaHFModel(OdesiaAbstractModel):
         self.output_dir = self.model_config['output_dir']
         self.test_case = self.dataset_config['evall_test_case']
         self.problem_type = self.dataset_config['problem_type']        
+        # Outputs of the forward pass kept after evaluate() for the splits that are predicted later,
+        # so each split goes through the network only once
+        self.prediction_splits = ['test']
+        self.prediction_outputs = {}
         # Tokenizer
         
         
-        # Load dataset if it was tokenized before
-        self.dataset = load_dataset('json', data_files=dataset_path)   
-        # language configs
-        language = ''
-        if dataset_path['train'].find('_es') > -1:
-            language = 'es' 
-        elif dataset_path['train'].find('_en') > -1:
-            language = 'en'     
-        self.dataset_path_tokenized = "/".join(dataset_path['train'].split('/')[:-1])+"/tokenized_"+model_path.replace("/","-")+"_"+language
-        if os.path.isdir(self.dataset_path_tokenized):
-            print("Loading pretokenized dataset...")
-            self.tokenizer = AutoTokenizer.from_pretrained(model_path) 
-            self.tokenized_dataset = None
-            self.tokenized_dataset = load_from_disk(self.dataset_path_tokenized)
+        # Datasets, tokenizer and initial weights shared by all the grid points of this model and dataset
+        self.session = session if session is not None else OdesiaSession(model_path, dataset_path)
+        if self.session.dataset is None:
+            with self.timer.phase('dataset_load'):
+                self.session.dataset = load_dataset('json', data_files=dataset_path)
+        self.dataset = self.session.dataset
+        # The tokenizer is always loaded with the same options, so that it matches the cached tokenizations
+        if self.session.tokenizer is None:
+            with self.timer.phase('tokenization'):
+                self.session.tokenizer = AutoTokenizer.from_pretrained(model_path, add_prefix_space=True) 
+        self.tokenizer = self.session.tokenizer
+        self.tokenized_dataset = self.session.tokenized_dataset
+
+    def load_model(self, load_function):
+        with self.timer.phase('model_init'):
+            return self.session.load_model(load_function, seed=self.model_config['hf_parameters'].get('seed', 42))
+
+    def cached_map(self, function, input_columns, parameters, **map_kwargs):
+        """
+        Tokenizes every split with dataset.map(function, batched=True) through the tokenization cache. The key
+        of a split is the hash of the tokenizer fingerprint, the tokenization parameters and the content of the
+        input columns, so datasets with the same texts (e.g. the exist_2023_t* variants) share their entries.
+        Unless the function removes the original columns, only the new columns are stored and the rest are
+        taken from the dataset.
+        """
+        fingerprint = tokenizer_fingerprint(self.tokenizer)
+        full_rows = 'remove_columns' in map_kwargs
+        tokenized_dataset = {}
+        for split in self.dataset:
+            dataset_split = self.dataset[split]
+            columns = [column for column in sorted(input_columns) if column in dataset_split.column_names]
+            key = hash_content(fingerprint, self.tokenization_format, sorted(parameters.items()), columns,
+                               [list(dataset_split[column]) for column in columns])
+            cached_split = load_tokenized_split(key, TOKENIZATION_CACHE_DIR)
+            if cached_split is None:
+                tokenized_split = dataset_split.map(function, batched=True, **map_kwargs)
+                if full_rows:
+                    cached_split = tokenized_split
+                else:
+                    cached_split = tokenized_split.select_columns([column for column in tokenized_split.column_names 
+                                                                   if column not in dataset_split.column_names])
+                save_tokenized_split(key, cached_split, TOKENIZATION_CACHE_DIR, TOKENIZATION_CACHE_MAX_SIZE_GB)
+            else:
+                print(f"Loading pretokenized {split} split...")
+            if full_rows:
+                tokenized_dataset[split] = cached_split
+            else:
+                tokenized_dataset[split] = concatenate_datasets([dataset_split, cached_split], axis=1)
+        self.session.tokenized_dataset = DatasetDict(tokenized_dataset)
+        return self.session.tokenized_dataset
+
+    def cached_text_map(self, function, text_column, parameters):
+        """
+        Like cached_map, for functions that tokenize each text on its own. The texts are tokenized once in a
+        store shared by all the datasets, keyed by the tokenizer and the tokenization parameters, and every split
+        selects its rows of the store and keeps its own columns. The exist_2023_t* variants have different subsets
+        of the same tweets, so they do not share the entries of cached_map.
+        """
+        store_key = 'texts_' + hash_content(tokenizer_fingerprint(self.tokenizer), self.tokenization_format, sorted(parameters.items()))
+        store = load_text_store(store_key, TOKENIZATION_CACHE_DIR)
+        known_hashes = set(store['text_hash']) if store is not None else set()
+        split_hashes = {}
+        new_texts = {}
+        for split in self.dataset:
+            texts = list(self.dataset[split][text_column])
+            split_hashes[split] = text_hashes(texts)
+            for text, text_hash in zip(texts, split_hashes[split]):
+                if text_hash not in known_hashes:
+                    new_texts.setdefault(text_hash, text)
+        if new_texts:
+            # only the texts that are not in the store yet are tokenized, and saved as a new shard
+            shard = Dataset.from_dict({'text_hash': list(new_texts), text_column: list(new_texts.values())})
+            shard = shard.map(function, batched=True, remove_columns=[text_column])
+            save_text_shard(store_key, shard, TOKENIZATION_CACHE_DIR, TOKENIZATION_CACHE_MAX_SIZE_GB)
+            store = load_text_store(store_key, TOKENIZATION_CACHE_DIR)
         else:
-            self.tokenizer = AutoTokenizer.from_pretrained(model_path, add_prefix_space=True) 
-            self.tokenized_dataset = None
+            print("Loading pretokenized texts...")
+        rows = {text_hash: row for row, text_hash in enumerate(store['text_hash'])}
+        tokenized_dataset = {}
+        for split in self.dataset:
+            # the selected rows are copied in memory, so nothing is written in the folders of the store
+            tokens = store.select([rows[text_hash] for text_hash in split_hashes[split]]).remove_columns('text_hash')
+            tokens = tokens.flatten_indices(keep_in_memory=True)
+            tokenized_dataset[split] = concatenate_datasets([self.dataset[split], tokens], axis=1)
+        self.session.tokenized_dataset = DatasetDict(tokenized_dataset)
+        return self.session.tokenized_dataset
 
-    def load_trainer(self, model, tokenized_dataset, data_collator, compute_metrics_function):        
-        
-        training_args = TrainingArguments(
+    def training_arguments(self):
+        # group_by_length builds batches of examples with similar length, so the collator adds less padding.
+        # The lengths are read from the 'length' column when the tokenized dataset has it
+        hf_parameters = dict(self.model_config['hf_parameters'])
+        hf_parameters.setdefault('group_by_length', self.model_config.get('group_by_length', False))
+        hf_parameters.setdefault('length_column_name', 'length')
+        return TrainingArguments(
             output_dir=self.output_dir,
             run_name=self.output_dir,
             overwrite_output_dir=True,
-            **self.model_config['hf_parameters']
+            **hf_parameters
         )
 
+    def timed_metrics(self, compute_metrics_function):
+        # mide el cálculo de métricas (ICM, seqeval, f1...) de cada evaluación del trainer
+        if compute_metrics_function is None:
+            return None
+        def compute_metrics(pred):
+            with self.timer.phase('metrics'):
+                return compute_metrics_function(pred)
+        return compute_metrics
+
+    def load_trainer(self, model, tokenized_dataset, data_collator, compute_metrics_function):        
+        
+        training_args = self.training_arguments()
+
         trainer = Trainer(
             model=model,
             args=training_args,
@@ -82,21 +203,78 @@ class OdesiaHFModel(OdesiaAbstractModel):
             eval_dataset=tokenized_dataset["val"],
             tokenizer=self.tokenizer,
             data_collator=data_collator,
-            compute_metrics=compute_metrics_function,
+            compute_metrics=self.timed_metrics(compute_metrics_function),
         )
         return trainer
 
     def train(self):
-        self.trainer.train()
+        self.prediction_outputs = {}
+        train_output = self.trainer.train()
+        self.log_throughput(train_output.metrics)
         self.trainer.save_model(self.output_dir+'/model')
 
+    def log_throughput(self, metrics):
+        # tokens reales (sin padding) procesados por segundo y duración media de cada epoch
+        train_dataset = self.tokenized_dataset['train']
+        if 'input_ids' not in train_dataset.column_names:
+            return
+        if 'length' in train_dataset.column_names:
+            tokens_per_epoch = int(np.sum(train_dataset['length']))
+        else:
+            tokens_per_epoch = sum(len(input_ids) for input_ids in train_dataset['input_ids'])
+        # state.epoch y no num_train_epochs, porque el entrenamiento puede pararse antes (successive halving)
+        epochs = self.trainer.state.epoch
+        runtime = metrics['train_runtime']
+        print(f">>>> Training throughput: {tokens_per_epoch * epochs / runtime:.1f} tokens/s, {runtime / epochs:.1f} s/epoch")
+
+    def run_prediction(self, split):
+        # The same output gives the evaluation metrics (with the eval_ prefix, as in trainer.evaluate) and the predictions
+        if split in self.prediction_outputs:
+            return self.prediction_outputs.pop(split)
+        return self.trainer.predict(self.tokenized_dataset[split], metric_key_prefix="eval")
+
     def predict(self, split="test"):
-        return self.trainer.predict(self.tokenized_dataset[split])
+        return self.run_prediction(split)
+
+    def reset_prediction_cache(self):
+        # Outputs kept from a previous forward pass, no longer valid when the model changes
+        self.prediction_outputs = {}
+
+    def quantized_inference_unsupported(self):
+        # None if predict/evaluate can run with the int8 model, otherwise the reason
+        if getattr(self, 'trainer', None) is None:
+            return f"{type(self).__name__} does not predict through a transformers model"
+        if self.trainer.args.device.type != 'cpu':
+            return "dynamic int8 quantization only runs on CPU"
+        return None
+
+    @contextmanager
+    def quantized_inference(self):
+        """
+        Inside the block, predict/evaluate use a copy of the fine-tuned model with its Linear layers dynamically
+        quantized to int8 (int8 weights, activations quantized on the fly). The fp32 model is restored afterwards.
+        """
+        fp32_model = self.trainer.model
+        quantized_model = torch.quantization.quantize_dynamic(copy.deepcopy(fp32_model).to('cpu').eval(), {torch.nn.Linear}, dtype=torch.qint8)
+        self.trainer.model = quantized_model
+        self.model = quantized_model
+        self.reset_prediction_cache()
+        try:
+            yield
+        finally:
+            self.trainer.model = fp32_model
+            self.model = fp32_model
+            self.reset_prediction_cache()
     
     def evaluate(self, split="val"):
-        return self.trainer.evaluate(eval_dataset=self.tokenized_dataset[split])
+        output = self.run_prediction(split)
+        if split in self.prediction_splits:
+            self.prediction_outputs[split] = output
+        self.trainer.log(output.metrics)
+        return output.metrics
     
     def purge_model(self):
+        self.prediction_outputs = {}
         del self.model
         del self.tokenizer
         torch.cuda.empty_cache()
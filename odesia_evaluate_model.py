@@ -1,158 +1,310 @@
 import copy
 from datetime import timedelta
+import importlib
 import itertools
 import json
+import multiprocessing
+import numbers
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from generate_csv import generate_csv_from_report
-from odesia_classification import OdesiaTextClassification, OdesiaTokenClassification, OdesiaTextClassificationWithDisagreements
-from odesia_qa import OdesiaQuestionAnswering
-from odesia_sentence_similarity import OdesiaSentenceSimilarity
+from odesia_report import append_run, load_completed_runs
+from odesia_timing import PhaseTimer
 from odesia_configs import DATASETS, GENERIC_MODEL_CONFIG
-from odesia_utils import compose_dataset_path, compose_output_dir, create_directories, create_grid, get_documents_in_folder, save_json
+from odesia_utils import compose_dataset_path, compose_output_dir, create_directories, create_grid, get_documents_in_folder, hparams_signature, save_json
 import time
 import datetime
 import shutil
 import os
-from transformers import logging
 import warnings
-import pandas as pd
 
 # Suprimir todas las advertencias de tipo UserWarning
 warnings.filterwarnings("ignore", category=UserWarning)
 
+#from transformers import logging
 #logging.set_verbosity_warning()
 #logging.set_verbosity_error()
 
+# problem_type -> (módulo, clase, si hay que llamar a setup()). Los módulos de las tareas, y con ellos torch,
+# transformers, sentence_transformers, evaluate o sklearn, solo se importan cuando se entrena un dataset de ese
+# tipo, así que importar este módulo (y arrancar cada proceso trabajador) es rápido
+TASK_REGISTRY = {
+    'single_label_classification': ('odesia_classification', 'OdesiaTextClassification', True),
+    '': ('odesia_classification', 'OdesiaTextClassification', True),
+    'multi_class_classification': ('odesia_classification', 'OdesiaTextClassification', True),
+    'multi_label_classification': ('odesia_classification', 'OdesiaTextClassification', True),
+    'token_classification': ('odesia_classification', 'OdesiaTokenClassification', False),
+    'question_answering': ('odesia_qa', 'OdesiaQuestionAnswering', False),
+    'sentence_similarity': ('odesia_sentence_similarity', 'OdesiaSentenceSimilarity', False),
+    'multi_class_classification_disagreements': ('odesia_classification', 'OdesiaTextClassificationWithDisagreements', True),
+    'multi_label_classification_disagreements': ('odesia_classification', 'OdesiaTextClassificationWithDisagreements', True),
+}
 
-def odesia_benchmark(model : str, language="es", grid_search : dict = None, datasets_to_eval : list = []):
-    
+
+def odesia_benchmark(model : str, language="es", grid_search : dict = None, datasets_to_eval : list = [], workers : int = 1, devices : list = None, search : str = "grid", 
+                     quantized_inference : bool = False):
+    jobs = create_jobs(model=model, language=language, grid_search=grid_search, datasets_to_eval=datasets_to_eval, search=search, 
+                       quantized_inference=quantized_inference)
+    run_jobs(jobs, workers=workers, devices=devices)
+    return
+
+def create_jobs(model : str, language="es", grid_search : dict = None, datasets_to_eval : list = [], search : str = "grid", quantized_inference : bool = False):
+    # cada trabajo es una combinación independiente (modelo, dataset, hiperparámetros)
+    # search='halving' para las configuraciones que van perdiendo en val (successive halving)
+    # quantized_inference=True repite evaluate/predict con el modelo cuantizado a int8 y compara con fp32
+    if search not in ('grid', 'halving'):
+        raise ValueError(f"Unknown search mode {search}. Use 'grid' or 'halving'.")
     grid = create_grid(grid_search)
-    datasets_len = len(datasets_to_eval) if datasets_to_eval else len(DATASETS)
-    total_trainings = datasets_len * len(grid) 
+    jobs = []
+    for task in DATASETS:
+        # si el dataset está en los elegidos por el usuario
+        if not datasets_to_eval or task['name'] in datasets_to_eval:
+            for hparams in grid:
+                jobs.append({'model': model, 'language': language, 'task': task, 'hparams': hparams, 'search': search, 
+                             'quantized_inference': quantized_inference})
+    return jobs
+
+def run_jobs(jobs : list, workers : int = 1, devices : list = None, threads_per_worker : int = None):
+    """
+    Runs the (model, dataset, hparams) jobs serially when workers <= 1, or in a pool of worker processes otherwise.
+    Only the parent process writes the run ledger, the csvs and purges the disk, so those writes never interleave.
+    devices is an optional list of CUDA device ids assigned round-robin to the workers, and threads_per_worker
+    limits the intra-op threads of each worker (by default the cores are split evenly between workers).
+    """
+    total_trainings = len(jobs)
+    # el índice de entrenamientos completados se lee una sola vez; los trabajos equivalentes
+    # (mismo batch efectivo) dentro de la misma llamada también se descartan
+    completed_runs = load_completed_runs()
+    pending_jobs = []
+    for job in jobs:
+        key = job_key(**job)
+        if key in completed_runs:
+            print(f">>>>>>>>> Already trained. Skipping model {job['model']} in {job['task']['name']} with {job['hparams']}.")
+            continue
+        completed_runs.add(key)
+        pending_jobs.append(job)
+
+    if workers <= 1:
+        current_iterations = 0
+        for job in pending_jobs:
+            result = train_grid_point(**job)
+            remaining_time_estimate = result['training_time'] * (total_trainings - current_iterations - 1)
+            current_iterations += 1
+            print("*****************************")
+            print(f"Iteration {current_iterations}/{total_trainings} - Estimated remaining for model {job['model']} in {job['task']['name']}: {format_remaining_time(remaining_time_estimate)}")
+            print("*****************************")
+            record_result(result)
+        return []
+
+    if threads_per_worker is None:
+        threads_per_worker = max(1, (os.cpu_count() or 1) // workers)
+
+    # 'spawn' es obligatorio para poder usar CUDA en los procesos hijos
+    context = multiprocessing.get_context('spawn')
+    worker_slots = context.Queue()
+    for slot in range(workers):
+        worker_slots.put(slot)
+
+    start_time = time.time()
     current_iterations = 0
+    failed_jobs = []
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=init_worker,
+                             initargs=(worker_slots, devices, threads_per_worker)) as executor:
+        futures = {executor.submit(train_grid_point, **job): job for job in pending_jobs}
+        for future in as_completed(futures):
+            job = futures[future]
+            current_iterations += 1
+            try:
+                result = future.result()
+            except Exception as e:
+                print(f"[{datetime.datetime.now()}] >>>> Job failed for model {job['model']} in {job['task']['name']} with {job['hparams']}: {e!r}")
+                failed_jobs.append(job)
+                continue
+
+            # los trabajos terminan en paralelo, así que estimamos el tiempo restante con el ritmo medio
+            elapsed_time = time.time() - start_time
+            remaining_time_estimate = elapsed_time / current_iterations * (len(pending_jobs) - current_iterations)
+            print("*****************************")
+            print(f"Iteration {current_iterations}/{len(pending_jobs)} ({workers} workers) - Finished model {job['model']} in {job['task']['name']}. Estimated remaining: {format_remaining_time(remaining_time_estimate)}")
+            print("*****************************")
+            record_result(result)
+
+    if failed_jobs:
+        print(f"{len(failed_jobs)} of {len(pending_jobs)} jobs failed.")
+    return failed_jobs
+
+def job_key(model, language, task, hparams, search='grid', quantized_inference=False):
+    hf_parameters = copy.deepcopy(GENERIC_MODEL_CONFIG['hf_parameters'])
+    hf_parameters.update(hparams)
+    # el modo de búsqueda forma parte de la clave: una ejecución parada por successive halving no cuenta
+    # como completa en un grid posterior
+    return (task['name'], language, model, hparams_signature(hf_parameters), search)
+
+def init_worker(worker_slots, devices, threads_per_worker):
+    # cada proceso toma un hueco libre, que decide la GPU que puede ver y cuántos hilos usa
+    slot = worker_slots.get()
+    if devices:
+        os.environ['CUDA_VISIBLE_DEVICES'] = str(devices[slot % len(devices)])
+    os.environ['OMP_NUM_THREADS'] = str(threads_per_worker)
+    import torch
+    torch.set_num_threads(threads_per_worker)
+
+def load_task_class(problem_type):
+    if problem_type not in TASK_REGISTRY:
+        raise ValueError("Unknown problem type. Please check the dataset configuration.")
+    module_name, class_name, needs_setup = TASK_REGISTRY[problem_type]
+    return getattr(importlib.import_module(module_name), class_name), needs_setup
+
+def load_odesia_model(model, dataset_path, model_config, dataset_config, session=None):
+    # inicializamos los modelos en función del tipo de problema del dataset
+    task_class, needs_setup = load_task_class(dataset_config['problem_type'])
+    odesia_model = task_class(model_path=model,
+                              dataset_path=dataset_path,
+                              model_config=model_config,
+                              dataset_config=dataset_config,
+                              session=session)
+    if needs_setup:
+        odesia_model.setup()
+    return odesia_model
+
+# Sesión del último (modelo, dataset, idioma) entrenado en este proceso. Los trabajos llegan agrupados,
+# así que normalmente todos los puntos del grid de un dataset reutilizan la misma
+CURRENT_SESSION = {'key': None, 'session': None}
+
+def get_session(model, dataset_name, language, dataset_path):
+    key = (model, dataset_name, language)
+    if CURRENT_SESSION['key'] != key:
+        # se libera la sesión anterior antes de cargar la nueva
+        CURRENT_SESSION['session'] = None
+        from odesia_core import OdesiaSession
+        CURRENT_SESSION['session'] = OdesiaSession(model, dataset_path)
+        CURRENT_SESSION['key'] = key
+    return CURRENT_SESSION['session']
+
+def train_grid_point(model, language, task, hparams, search='grid', quantized_inference=False):
+    # entrena, evalúa y predice una combinación de hiperparámetros. Puede ejecutarse en un proceso hijo,
+    # por lo que no escribe en el registro de ejecuciones: devuelve el registro para que lo guarde el proceso principal
+    start_time = time.time()
+    dataset_name = task['name']        
+    dataset_config = task['dataset_config']
+    dataset_path = compose_dataset_path(dataset_name, language)
+
+    # cargamos los diccionarios con la config del modelo y creamos las carpetas donde lo almacenaremos
+    model_config = copy.deepcopy(GENERIC_MODEL_CONFIG)
+    model_config['output_dir'] = compose_output_dir(dataset_name, model, hparams, language)                
+    create_directories(model_config['output_dir'])
+
+    # añadimos los parametros del grid que vamos a estudiar
+    model_config['hf_parameters'].update(hparams)                 
+    
+    session = get_session(model, dataset_name, language, dataset_path)
+    odesia_model = load_odesia_model(model, dataset_path, model_config, dataset_config, session)
+    halving = None
+    if search == 'halving':
+        from odesia_search import enable_successive_halving
+        halving = enable_successive_halving(odesia_model, 
+                                            bracket=[model, dataset_name, language], 
+                                            signature=hparams_signature(model_config['hf_parameters']), 
+                                            main_metric=dataset_config['main_metric'])
     
+    print(f"[{datetime.datetime.now()}] >>>> Training...")                
+    with odesia_model.timer.phase('train'):
+        odesia_model.train()
+    trainer = getattr(odesia_model, 'trainer', None)
+    epochs = trainer.state.epoch if trainer is not None else model_config['hf_parameters']['num_train_epochs']
+    odesia_model.timer.set_throughput('train', len(odesia_model.dataset['train']) * epochs)
 
-    # recorremos todos los datasets de ODESIA
-    for task in DATASETS:
-        dataset_name = task['name']        
-        dataset_config = task['dataset_config']
-        dataset_path = compose_dataset_path(dataset_name, language)
+    print(f"[{datetime.datetime.now()}] >>>> Evaluation...", datetime.datetime.now())
+    evaluation_report = save_evaluation_report(odesia_model)
 
-        # si el dataset está en los elegidos por el usuario
-        if not datasets_to_eval or dataset_name in datasets_to_eval:
+    print(f"[{datetime.datetime.now()}] >>>> Prediction...", datetime.datetime.now())                
+    save_predictions(odesia_model)
 
-            # para cada dataset buscamos el mejor modelo con nuestro grid
-            for hparams in grid:
+    quantized_report = None
+    if quantized_inference:
+        print(f"[{datetime.datetime.now()}] >>>> Quantized (int8) evaluation and prediction...")
+        quantized_report = compare_quantized_inference(odesia_model, evaluation_report, dataset_config['main_metric'])
+
+    # quitamos de la memoria de la gpu el modelo
+    odesia_model.purge_model()
+    
+    return {'model': model,
+            'model_config': model_config,
+            'dataset': dataset_name,
+            'language': language,
+            'main_metric': dataset_config['main_metric'],
+            'training_time': time.time() - start_time,
+            'evaluation': evaluation_report,
+            'search': {'mode': search, 'stopped_at_epoch': halving.stopped_at_epoch if halving else None},
+            'quantized_inference': quantized_report,
+            'timings': odesia_model.timer.phases}
+
+def compare_quantized_inference(odesia_model, evaluation_report, main_metric):
+    # Repite evaluate/predict con el modelo cuantizado a int8: speedup de cada fase respecto a fp32 y diferencia
+    # de las métricas (int8 - fp32), para decidir por dataset si la evaluación cuantizada es aceptable
+    reason = odesia_model.quantized_inference_unsupported()
+    if reason is not None:
+        print(f"Skipping quantized inference: {reason}")
+        return {'skipped': reason}
+    with odesia_model.quantized_inference():
+        quantized_evaluation = save_evaluation_report(odesia_model, suffix='_int8')
+        save_predictions(odesia_model, suffix='_int8')
+
+    # predict reutiliza las salidas de evaluate_test, así que solo las fases de evaluate miden un forward completo
+    phases = odesia_model.timer.phases
+    speedup = {phase: phases[phase]['wall_time'] / phases[phase+'_int8']['wall_time'] 
+               for phase in ['evaluate_val', 'evaluate_test'] if phases.get(phase+'_int8', {}).get('wall_time')}
+    metric_delta = {}
+    for split in quantized_evaluation:
+        metric_delta[split] = {}
+        for metric, value in quantized_evaluation[split].items():
+            if 'runtime' in metric or 'per_second' in metric:
+                continue
+            # las métricas ICM son cadenas '%.4f'
+            quantized_value, fp32_value = metric_value(value), metric_value(evaluation_report[split].get(metric))
+            if quantized_value is not None and fp32_value is not None:
+                metric_delta[split][metric] = quantized_value - fp32_value
+    main_metric_delta = {split: metric_delta[split].get(main_metric) for split in metric_delta}
+    print(f">>>> Quantized inference speedup: {speedup}, {main_metric} delta: {main_metric_delta}")
+    return {'speedup': speedup, 
+            'main_metric_delta': main_metric_delta, 
+            'metric_delta': metric_delta, 
+            'evaluation': quantized_evaluation}
+
+def metric_value(value):
+    # valor numérico de una métrica, None si no es un número (p. ej. las f1 por clase)
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, numbers.Real):
+        return float(value)
+    if isinstance(value, str):
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    return None
+
+def record_result(result):
+    # limpiamos el disco duro (antes de guardar la ejecución, para que su tiempo quede en el registro)
+    timer = PhaseTimer()
+    with timer.phase('disk_purge'):
+        purge_disk(path = '/'.join(result['model_config']['output_dir'].split('/')[0:-1]), 
+                   main_metric=result['main_metric'], 
+                   num_model_preserve = 1)
+    timings = {**result['timings'], **timer.phases}
+
+    # guardamos los datos de la ejecución por si necesitamos reanudarla en algún momento
+    append_model_to_history(result['model'], result['model_config'], result['dataset'], result['language'], result['training_time'], result['evaluation'], 
+                            search=result['search'], quantized_inference=result['quantized_inference'], timings=timings)
+    generate_csv_from_report(dataset=result['dataset'], language=result['language'])
 
-                start_time = time.time()
-
-                # cargamos los diccionarios con la config del modelo y creamos las carpetas donde lo almacenaremos
-                model_config = copy.copy(GENERIC_MODEL_CONFIG)
-                model_config['output_dir'] = compose_output_dir(dataset_name, model, hparams, language)                
-                create_directories(model_config['output_dir'])
-                
-                csv_file_past_trainings = f'csvs/{dataset_name}_{language}.csv'                
-                if os.path.isfile(path=csv_file_past_trainings):
-                    # si ya tenemos este modelo entrenado, pasamos
-                    df_past_trainings = pd.read_csv(csv_file_past_trainings)                
-                    '''
-                    Este fragmento habrá que borrarlo en la versión final, o hacerlo de otra manera.
-                    Si el modelo es grande y hay que hacer una acumulación de gradiente, 
-                    hay que hallar si se ha entrenado un modelo equivalente de tal manera que no se entrene dos veces.
-                    '''
-                    list_grid_models = df_past_trainings['model_config.output_dir'].unique()
-                    dict_equivalences = {32: ['per_device_train_batch_size_8_gradient_accumulation_steps_4', 'per_device_train_batch_size_4_gradient_accumulation_steps_8', 'per_device_train_batch_size_32'],
-                                        16: ['per_device_train_batch_size_8_gradient_accumulation_steps_2', 'per_device_train_batch_size_4_gradient_accumulation_steps_4', 'per_device_train_batch_size_16']}
-                    already_trained = False
-                    if hparams.get('gradient_accumulation_steps') != None:
-                        total_batch_size = hparams['gradient_accumulation_steps'] * hparams['per_device_train_batch_size']
-                        for elemento in dict_equivalences[total_batch_size]:
-                            elemento = '/'.join(model_config['output_dir'].split("/")[:-1]) + f"/_{elemento}_learning_rate_{hparams['learning_rate']}_weight_decay_{hparams['weight_decay']}"
-                            if elemento in list_grid_models:
-                                print("<<<>>>> It was already trained in other configuration.", elemento)
-                                already_trained = True
-                                
-                    if already_trained:
-                        continue
-
-                    if model_config['output_dir'] in list_grid_models:
-                        print(f">>>>>>>>> Already trained. Skipping model {model_config['output_dir']}.")
-                        continue
-
-                # añadimos los parametros del grid que vamos a estudiar
-                model_config['hf_parameters'].update(hparams)                 
-                
-                # inicializamos los modelos en función del tipo de problema del dataset
-                problem_type = task['dataset_config']['problem_type']            
-                if problem_type in ['single_label_classification', '', 'multi_class_classification', 'multi_label_classification']:
-                    odesia_model = OdesiaTextClassification(model_path=model,
-                                                            dataset_path=dataset_path,
-                                                            model_config=model_config,
-                                                            dataset_config=dataset_config)
-                    odesia_model.setup()
-
-                elif problem_type == "token_classification":
-                    odesia_model = OdesiaTokenClassification(model_path=model,
-                                                            dataset_path=dataset_path,
-                                                            model_config=model_config,
-                                                            dataset_config=dataset_config)
-                elif problem_type == "question_answering":
-                    odesia_model = OdesiaQuestionAnswering(model_path=model,
-                                                            dataset_path=dataset_path,
-                                                            model_config=model_config,
-                                                            dataset_config=dataset_config)
-                elif problem_type == "sentence_similarity":
-                    odesia_model = OdesiaSentenceSimilarity(model_path=model,
-                                                            dataset_path=dataset_path,
-                                                            model_config=model_config,
-                                                            dataset_config=dataset_config)
-                elif problem_type in ["multi_class_classification_disagreements", "multi_label_classification_disagreements"]:
-                    odesia_model = OdesiaTextClassificationWithDisagreements(model_path=model,
-                                                                            dataset_path=dataset_path,
-                                                                            model_config=model_config,
-                                                                            dataset_config=dataset_config)
-                    odesia_model.setup() 
-                else: 
-                    raise ValueError("Unknown problem type. Please check the dataset configuration.")
-                
-                print(f"[{datetime.datetime.now()}] >>>> Training...")                
-                odesia_model.train()
-
-                print(f"[{datetime.datetime.now()}] >>>> Evaluation...", datetime.datetime.now())
-                evaluation_report = save_evaluation_report(odesia_model)
-
-                print(f"[{datetime.datetime.now()}] >>>> Prediction...", datetime.datetime.now())                
-                save_predictions(odesia_model)
-
-                # quitamos de la memoria de la gpu el modelo
-                odesia_model.purge_model()
-                
-                # calculamos el tiempo de esta ejecucion
-                iteration_time = time.time() - start_time
-
-                remaining_time_estimate = iteration_time * (total_trainings - current_iterations - 1)
-
-                days = int(remaining_time_estimate // (24 * 3600))
-                hours = int((remaining_time_estimate % (24 * 3600)) // 3600)
-                minutes = int((remaining_time_estimate % 3600) // 60)
-                seconds = int(remaining_time_estimate % 60)
-                current_iterations += 1
-                print("*****************************")
-                print(f"Iteration {current_iterations}/{total_trainings} - Estimated remaining for model {model} in {dataset_name}: {days} days, {hours} hours, {minutes} minutes, {seconds} seconds")
-                print("*****************************")
-                
-                # guardamos los datos de la ejecución por si necesitamos reanudarla en algún momento
-                append_model_to_history(model, model_config, dataset_name, language, iteration_time, evaluation_report)
-                generate_csv_from_report()
-                
-                # limpiamos el disco duro
-                purge_disk(path = '/'.join(model_config['output_dir'].split('/')[0:-1]), 
-                           main_metric=odesia_model.dataset_config['main_metric'], 
-                           num_model_preserve = 1)
-    return     
-
-def append_model_to_history(model, model_config, dataset, language, time, evaluation_report):
-    report = json.load(open('./report.json'))
+def format_remaining_time(remaining_time_estimate):
+    days = int(remaining_time_estimate // (24 * 3600))
+    hours = int((remaining_time_estimate % (24 * 3600)) // 3600)
+    minutes = int((remaining_time_estimate % 3600) // 60)
+    seconds = int(remaining_time_estimate % 60)
+    return f"{days} days, {hours} hours, {minutes} minutes, {seconds} seconds"
 
+def append_model_to_history(model, model_config, dataset, language, time, evaluation_report, **extra):
     row = {
         'date': str(datetime.datetime.now()),
         'dataset':dataset,
@@ -161,22 +313,26 @@ def append_model_to_history(model, model_config, dataset, language, time, evalua
         'language':language,
         'training_time':time,
         'evaluation':evaluation_report,
+        **extra,
     }
     
-    report.append(row)
-    save_json(path='./report.json', data=report)
+    append_run(row)
 
-def save_predictions(model):
-    predictions = model.predict()
-    save_json(f"{model.model_config['output_dir']}/predictions.json", predictions)
+def save_predictions(model, suffix=''):
+    with model.timer.phase(f'predict{suffix}'):
+        predictions = model.predict()
+    model.timer.set_throughput(f'predict{suffix}', len(model.dataset['test']))
+    save_json(f"{model.model_config['output_dir']}/predictions{suffix}.json", predictions)
     
-def save_evaluation_report(model):
+def save_evaluation_report(model, suffix=''):
     evaluation_report = {}
     for split in ['val', 'test']:
-         evaluation_output = model.evaluate(split=split)
+         with model.timer.phase(f'evaluate_{split}{suffix}'):
+             evaluation_output = model.evaluate(split=split)
+         model.timer.set_throughput(f'evaluate_{split}{suffix}', len(model.dataset[split]))
          evaluation_report[split] = evaluation_output
     
-    save_json(f"{model.model_config['output_dir']}/evaluation.json", evaluation_report) 
+    save_json(f"{model.model_config['output_dir']}/evaluation{suffix}.json", evaluation_report) 
     return evaluation_report
 
 def purge_disk(path, main_metric, num_model_preserve):
@@ -0,0 +1,121 @@
+import argparse
+import os
+import time
+import numpy as np
+from odesia_configs import DATASETS
+from odesia_evaluate_model import TASK_REGISTRY
+from odesia_utils import compose_dataset_path, save_json
+
+'''
+Offline inference with a trained model: predicts a split (or any json file with the same format) of a dataset
+and writes the predictions to a JSONL file as they are computed, in large batches. Only the tokenizer and the
+weights are loaded: no Trainer, training arguments, optimizer or tokenization of the other splits.
+
+    python odesia_predict.py trained_models/roberta-large/multiconer_2022_en/_per_device_train_batch_size_8_learning_rate_5e-05 multiconer_2022 --language en
+
+Supports the text classification (with or without disagreements) and token classification datasets.
+'''
+
+# clase de la tarea -> cómo se tokeniza y se decodifica la salida del modelo
+PREDICTION_MODES = {
+    'OdesiaTextClassification': 'text',
+    'OdesiaTextClassificationWithDisagreements': 'text',
+    'OdesiaTokenClassification': 'tokens',
+}
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('model_dir', type=str, help='Trained model directory (the grid point folder under trained_models/ or its model/ folder)')
+    parser.add_argument('dataset', type=str, help='Dataset name in DATASETS')
+    parser.add_argument('-l', '--language', type=str, default='es', help='Language of the dataset')
+    parser.add_argument('-i', '--input', type=str, default=None, help='Json file to predict (by default the test split of the dataset)')
+    parser.add_argument('-o', '--output', type=str, default=None, help='Output JSONL file, .gz to compress it (by default predictions_<dataset>_<language>.jsonl in model_dir)')
+    parser.add_argument('-b', '--batch_size', type=int, default=256, help='Examples per forward pass')
+    parser.add_argument('-t', '--threads', type=int, default=None, help='Intra-op threads of torch (by default all the cores)')
+    parser.add_argument('-d', '--device', type=str, default=None, help='cpu, cuda, cuda:1... (by default cuda if available)')
+    return parser.parse_args()
+
+def find_dataset_config(dataset_name):
+    for task in DATASETS:
+        if task['name'] == dataset_name:
+            return task['dataset_config']
+    raise ValueError(f"Unknown dataset {dataset_name}. Please check DATASETS in odesia_configs.py.")
+
+def prediction_mode(dataset_config):
+    problem_type = dataset_config['problem_type']
+    if problem_type not in TASK_REGISTRY:
+        raise ValueError("Unknown problem type. Please check the dataset configuration.")
+    _, class_name, _ = TASK_REGISTRY[problem_type]
+    if class_name not in PREDICTION_MODES:
+        raise ValueError(f"Offline prediction is not supported for {problem_type} datasets.")
+    return PREDICTION_MODES[class_name]
+
+def iter_predictions(model, tokenizer, dataset, dataset_config, mode, batch_size, device):
+    # Genera las predicciones ejemplo a ejemplo, calculadas por lotes; cada lote se rellena hasta su ejemplo más largo
+    import torch
+    from odesia_classification import convert_logits, predicted_labels, predicted_word_labels
+
+    problem_type = dataset_config['problem_type']
+    label_list = list(dataset_config['label2id'].keys())
+    id2label = {v: k for k, v in dataset_config['label2id'].items()}
+    label_names = np.array([id2label[i] for i in range(len(id2label))], dtype=object)
+
+    for batch in dataset.iter(batch_size=batch_size):
+        if mode == 'text':
+            inputs = tokenizer(batch['text'], truncation=True, padding=True, return_tensors='pt')
+        else:
+            inputs = tokenizer(batch['tokens'], is_split_into_words=True, truncation=True, padding=True, return_tensors='pt')
+        with torch.inference_mode():
+            logits = model(**inputs.to(device)).logits.float().cpu().numpy()
+
+        if mode == 'text':
+            labels = predicted_labels(convert_logits(logits, problem_type), problem_type, label_names)
+            for example_id, example_labels in zip(batch['id'], labels):
+                yield {'test_case': dataset_config['evall_test_case'], 'id': example_id, 'label': example_labels}
+        else:
+            word_ids = np.array([[-1 if word_id is None else word_id for word_id in inputs.word_ids(i)]
+                                 for i in range(len(batch['tokens']))], dtype=np.int64)
+            num_words = np.array([len(tokens) for tokens in batch['tokens']])
+            ner_tags = predicted_word_labels(np.argmax(logits, axis=2), word_ids, num_words, label_list)
+            for example_id, example_tags, tokens in zip(batch['id'], ner_tags, batch['tokens']):
+                yield {'id': example_id, 'ner_tags': example_tags, 'tokens': tokens}
+
+def predict_to_jsonl(model_dir, dataset_name, language='es', input_path=None, output_path=None, batch_size=256, threads=None, device=None):
+    import torch
+    from datasets import load_dataset
+    from transformers import AutoTokenizer, AutoModelForSequenceClassification, AutoModelForTokenClassification
+
+    dataset_config = find_dataset_config(dataset_name)
+    mode = prediction_mode(dataset_config)
+    if os.path.isdir(os.path.join(model_dir, 'model')):
+        model_dir = os.path.join(model_dir, 'model')
+    if input_path is None:
+        input_path = compose_dataset_path(dataset_name, language)['test']
+    if output_path is None:
+        output_path = os.path.join(model_dir, f'predictions_{dataset_name}_{language}.jsonl')
+    if threads is not None:
+        torch.set_num_threads(threads)
+    if device is None:
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+    # el tokenizador se guarda con el modelo; add_prefix_space como en el entrenamiento
+    tokenizer = AutoTokenizer.from_pretrained(model_dir, add_prefix_space=True)
+    model_class = AutoModelForSequenceClassification if mode == 'text' else AutoModelForTokenClassification
+    model = model_class.from_pretrained(model_dir).to(device)
+    model.eval()
+    dataset = load_dataset('json', data_files=input_path, split='train')
+
+    start_time = time.time()
+    save_json(output_path, iter_predictions(model, tokenizer, dataset, dataset_config, mode, batch_size, device), jsonl=True)
+    elapsed_time = time.time() - start_time
+    print(f"Predicted {len(dataset)} examples of {input_path} in {elapsed_time:.1f}s ({len(dataset)/max(elapsed_time, 1e-9):.1f} examples/s, {torch.get_num_threads()} threads, {device}).")
+    print(f"Predictions saved in {output_path}")
+    return output_path
+
+def main():
+    args = parse_arguments()
+    predict_to_jsonl(args.model_dir, args.dataset, language=args.language, input_path=args.input, output_path=args.output,
+                     batch_size=args.batch_size, threads=args.threads, device=args.device)
+
+if __name__ == "__main__":
+    main()
@@ -1,46 +1,65 @@
+import time
+import numpy as np
 import torch 
+from torch.utils.data import DataLoader
 from odesia_core import OdesiaHFModel
 from transformers import (AutoModelForQuestionAnswering, 
-                          pipeline, 
                           DefaultDataCollator)
-from evaluate import load
+from odesia_cache import load_metric
 
 
 class OdesiaQuestionAnswering(OdesiaHFModel):
+    max_length = 384
+    # Overlap between consecutive windows of a long context at inference time
+    doc_stride = 128
+    max_answer_length = 30
+    n_best_size = 20
+    inference_batch_size = 64
     
-    def __init__(self, model_path, dataset_path, model_config, dataset_config):                
-        super().__init__(model_path, dataset_path, model_config, dataset_config)
+    def __init__(self, model_path, dataset_path, model_config, dataset_config, session=None):                
+        super().__init__(model_path, dataset_path, model_config, dataset_config, session)
         
         # Step 1. Load DataCollator            
         self.data_collator = DefaultDataCollator()      
 
         # Step 2. Tokenized the dataset 
         if not self.tokenized_dataset:            
-            self.tokenized_dataset = self.dataset.map(self.preprocess_function, 
-                                                      batched=True, 
-                                                      remove_columns=self.dataset["train"].column_names)
-            self.tokenized_dataset.save_to_disk(self.dataset_path_tokenized)
+            with self.timer.phase('tokenization'):
+                self.tokenized_dataset = self.cached_map(self.preprocess_function, 
+                                                         input_columns=["question", "context", "answers"], 
+                                                         parameters={"function": "preprocess_function", "max_length": self.max_length, "padding": "max_length"}, 
+                                                         remove_columns=self.dataset["train"].column_names)
 
         # Step 3. Loading model, trainer and metrics     
-        self.model = AutoModelForQuestionAnswering.from_pretrained(model_path)   
+        self.model = self.load_model(lambda: AutoModelForQuestionAnswering.from_pretrained(model_path))   
         self.trainer = self.load_trainer(model=self.model, 
                                          data_collator=self.data_collator, 
                                          tokenized_dataset=self.tokenized_dataset, 
                                          compute_metrics_function=None)
-        self.metric = load("squad")
+        self.metric = load_metric("squad")
         self.predictions = {}
+        # Tokenized windows of each split used for inference, shared by evaluate() and predict()
+        self.prediction_features = {}
 
-    def preprocess_function(self, examples):
+    def reset_prediction_cache(self):
+        super().reset_prediction_cache()
+        self.predictions = {}
+
+    def tokenize_questions(self, examples, **kwargs):
         questions = [q.strip() for q in examples["question"]]
-        inputs = self.tokenizer(
+        return self.tokenizer(
             questions,
             examples["context"],
-            max_length=384,
+            max_length=self.max_length,
             truncation="only_second",
             return_offsets_mapping=True,
             padding="max_length",
+            **kwargs
         )
 
+    def preprocess_function(self, examples):
+        inputs = self.tokenize_questions(examples)
+
         offset_mapping = inputs.pop("offset_mapping")
         answers = examples["answers"]
         start_positions = []
@@ -81,51 +100,135 @@ class OdesiaQuestionAnswering(OdesiaHFModel):
         inputs["end_positions"] = end_positions
         return inputs
 
+    def clamp_num_examples(self, split, num_examples):
+        # predict guarda sus resultados con este número de ejemplos, que no puede superar la longitud del split
+        len_num_example = len(self.dataset[split])
+        return len_num_example if num_examples == "max" or num_examples > len_num_example else num_examples
+
     def evaluate(self, split="val"):
-        if split in self.predictions:
-            results_prediction = self.predictions[split]
+        num_examples = self.clamp_num_examples(split, 500)
+        if (split, num_examples) in self.predictions:
+            results_prediction = self.predictions[(split, num_examples)]
         else:
-            results_prediction = self.predict(split=split, num_examples = 500, return_references=True)
+            results_prediction = self.predict(split=split, num_examples=num_examples, return_references=True)
         predictions = []
         # eliminamos todo de las predicciones, menos las claves que nos hacen falta
         for prediction in results_prediction['predictions']:
             # renombrar prediction a label
             prediction = {key: value for key, value in prediction.items() if key in ['id', 'prediction_text']}
             predictions.append(prediction)
-        results = self.metric.compute(predictions=predictions, references=results_prediction['references'])
+        with self.timer.phase('metrics'):
+            results = self.metric.compute(predictions=predictions, references=results_prediction['references'])
         return results
     
     def predict(self, split="test", num_examples = "max", return_references=False):
-        len_num_example = len(self.dataset[split])
-        num_examples = len_num_example if num_examples == "max" or num_examples > len_num_example else num_examples        
+        num_examples = self.clamp_num_examples(split, num_examples)
         predictions_dataset = self.dataset[split].select(range(num_examples))
-        
-        question_answerer = pipeline("question-answering", model=self.model.to(torch.device("cpu")), tokenizer=self.tokenizer)
-        
-        
-        num_predictions = len(predictions_dataset)
+
+        # Long contexts are split in overlapping windows, each window is a feature of its example
+        features = self.get_prediction_features(split)
+        features = features.select(range(int(np.searchsorted(features['example_index'], num_examples))))
+
+        start_time = time.time()
+        start_logits, end_logits = self.forward_features(features)
+        answers = self.decode_answers(start_logits, end_logits,
+                                      offsets=np.array(features['offset_mapping']),
+                                      example_index=np.array(features['example_index']),
+                                      contexts=predictions_dataset['context'])
+        elapsed_time = time.time() - start_time
+        print(f"Question answering inference on {split}: {num_examples} examples ({len(features)} features) in {elapsed_time:.1f}s, {num_examples/max(elapsed_time, 1e-9):.1f} examples/s")
+
         predictions = []
-        references = []
-        for i,item in enumerate(predictions_dataset):            
-            
-            result = question_answerer(question=item["question"], context=item['context'])                        
-            result['prediction_text'] = result['answer']
-            del result['answer']
-            result['id'] = item["id"]
-            
-            if i%200 == 0:
-                print(f"Generation prediction ({i} of {num_predictions}){result}")
-            
-            predictions.append(result)    
-            references.append({'answers' : item['answers'], "id":item["id"]})
-        
-        self.predictions[split] = predictions
+        for answer, example_id in zip(answers, predictions_dataset['id']):
+            answer['id'] = example_id
+            predictions.append(answer)
+        references = [{'answers' : answers, "id": example_id} for answers, example_id in zip(predictions_dataset['answers'], predictions_dataset['id'])]
+
+        self.predictions[(split, num_examples)] = {'predictions': predictions,
+                                                   'references' : references}
 
         if return_references:
             return {'predictions': predictions,
                     'references' : references} 
         else:
             return {split:predictions}
+
+    def get_prediction_features(self, split):
+        if split not in self.prediction_features:
+            self.prediction_features[split] = self.dataset[split].map(self.prepare_prediction_features, 
+                                                                      batched=True, 
+                                                                      with_indices=True,
+                                                                      remove_columns=self.dataset[split].column_names)
+        return self.prediction_features[split]
+
+    def prepare_prediction_features(self, examples, indices):
+        inputs = self.tokenize_questions(examples, stride=self.doc_stride, return_overflowing_tokens=True)
+        sample_mapping = inputs.pop("overflow_to_sample_mapping")
+
+        # Only the offsets of the context are kept, the rest are marked with -1 so they cannot be part of an answer
+        for i in range(len(inputs["input_ids"])):
+            sequence_ids = inputs.sequence_ids(i)
+            inputs["offset_mapping"][i] = [list(offset) if sequence_ids[k] == 1 else [-1, -1] 
+                                           for k, offset in enumerate(inputs["offset_mapping"][i])]
+        inputs["example_index"] = [indices[sample] for sample in sample_mapping]
+        return inputs
+
+    def forward_features(self, features):
+        device = self.trainer.args.device
+        model = self.model.to(device)
+        model.eval()
+
+        model_inputs = [column for column in ['input_ids', 'attention_mask', 'token_type_ids'] if column in features.column_names]
+        dataloader = DataLoader(features.with_format('torch', columns=model_inputs), batch_size=self.inference_batch_size)
+        start_logits, end_logits = [], []
+        with torch.no_grad():
+            for batch in dataloader:
+                outputs = model(**{key: value.to(device) for key, value in batch.items()})
+                start_logits.append(outputs.start_logits.float().cpu().numpy())
+                end_logits.append(outputs.end_logits.float().cpu().numpy())
+        return np.concatenate(start_logits), np.concatenate(end_logits)
+
+    def decode_answers(self, start_logits, end_logits, offsets, example_index, contexts):
+        num_features = len(start_logits)
+        features_range = np.arange(num_features)
+        in_context = offsets[:, :, 0] >= 0
+        start_logits = np.where(in_context, start_logits, -np.inf)
+        end_logits = np.where(in_context, end_logits, -np.inf)
+
+        # Best n start and end positions of every feature, and the scores of all their combinations
+        top_start = np.argsort(-start_logits, axis=1)[:, :self.n_best_size]
+        top_end = np.argsort(-end_logits, axis=1)[:, :self.n_best_size]
+        scores = np.take_along_axis(start_logits, top_start, axis=1)[:, :, None] + np.take_along_axis(end_logits, top_end, axis=1)[:, None, :]
+        span_length = top_end[:, None, :] - top_start[:, :, None] + 1
+        scores = np.where((span_length > 0) & (span_length <= self.max_answer_length), scores, -np.inf)
+
+        best_span = scores.reshape(num_features, -1).argmax(axis=1)
+        best_score = scores.reshape(num_features, -1)[features_range, best_span]
+        best_start = top_start[features_range, best_span // self.n_best_size]
+        best_end = top_end[features_range, best_span % self.n_best_size]
+
+        # Probability of the span, as reported by the question-answering pipeline
+        with np.errstate(invalid='ignore', over='ignore'):
+            log_norm_start = np.logaddexp.reduce(start_logits, axis=1)
+            log_norm_end = np.logaddexp.reduce(end_logits, axis=1)
+            probabilities = np.exp(best_score - log_norm_start - log_norm_end)
+
+        # For each example keep the window with the best span
+        order = np.lexsort((-best_score, example_index))
+        examples, first_feature = np.unique(example_index[order], return_index=True)
+        best_features = order[first_feature]
+
+        answers = [{'score': 0.0, 'start': 0, 'end': 0, 'prediction_text': ''} for _ in contexts]
+        for example, feature in zip(examples, best_features):
+            if not np.isfinite(best_score[feature]):
+                continue
+            start_char = int(offsets[feature, best_start[feature], 0])
+            end_char = int(offsets[feature, best_end[feature], 1])
+            answers[example] = {'score': float(probabilities[feature]), 
+                                'start': start_char, 
+                                'end': end_char, 
+                                'prediction_text': contexts[example][start_char:end_char]}
+        return answers
                 
     def compute_metrics(self):
         return None
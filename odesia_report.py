@@ -0,0 +1,108 @@
+import json
+import os
+import sqlite3
+from odesia_utils import dumps_json, hparams_signature
+
+# Append-only ledger with one row per finished training. It replaces report.json, which had to be
+# read and rewritten completely after every training.
+REPORT_DB = './report.db'
+LEGACY_REPORT_JSON = './report.json'
+
+def connect_report(path=REPORT_DB, legacy_json_path=LEGACY_REPORT_JSON):
+    # The runs of an old report.json are imported when the ledger is created, whatever the entry point
+    created = not os.path.exists(path)
+    # WAL lets several processes append at the same time, and synchronous=FULL fsyncs every commit,
+    # so a run killed in the middle of a write never corrupts the previous ones
+    connection = sqlite3.connect(path, timeout=60)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=FULL')
+    connection.execute('''CREATE TABLE IF NOT EXISTS runs (
+                            id INTEGER PRIMARY KEY AUTOINCREMENT,
+                            date TEXT,
+                            dataset TEXT,
+                            language TEXT,
+                            model TEXT,
+                            output_dir TEXT,
+                            record TEXT)''')
+    connection.execute('CREATE INDEX IF NOT EXISTS runs_dataset_language_output_dir ON runs (dataset, language, output_dir)')
+    # Validation metric of each configuration at the rungs of the successive halving search
+    connection.execute('''CREATE TABLE IF NOT EXISTS rungs (
+                            bracket TEXT,
+                            signature TEXT,
+                            epoch INTEGER,
+                            metric REAL,
+                            PRIMARY KEY (bracket, signature, epoch))''')
+    if created:
+        import_legacy_report(connection, legacy_json_path)
+    return connection
+
+def insert_run(connection, row):
+    connection.execute('INSERT INTO runs (date, dataset, language, model, output_dir, record) VALUES (?, ?, ?, ?, ?, ?)',
+                       (row['date'], row['dataset'], row['language'], row['model'], row['model_config']['output_dir'],
+                        dumps_json(row)))
+
+def append_run(row, path=REPORT_DB):
+    connection = connect_report(path)
+    with connection:
+        insert_run(connection, row)
+    connection.close()
+
+def load_runs(dataset=None, language=None, path=REPORT_DB):
+    # Rows in insertion order, optionally only the ones of a dataset and language
+    connection = connect_report(path)
+    query = 'SELECT record FROM runs'
+    conditions, parameters = [], []
+    if dataset is not None:
+        conditions.append('dataset = ?')
+        parameters.append(dataset)
+    if language is not None:
+        conditions.append('language = ?')
+        parameters.append(language)
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+    rows = [json.loads(record) for (record,) in connection.execute(query + ' ORDER BY id', parameters)]
+    connection.close()
+    return rows
+
+def load_completed_runs(path=REPORT_DB):
+    # Index of the finished trainings, keyed by (dataset, language, model, hyperparameter signature, search mode).
+    # A run stopped early by successive halving only counts for 'halving' sweeps; a full run counts for both
+    completed_runs = set()
+    for row in load_runs(path=path):
+        key = (row['dataset'], row['language'], row['model'], hparams_signature(row['model_config']['hf_parameters']))
+        stopped_at_epoch = (row.get('search') or {}).get('stopped_at_epoch')
+        completed_runs.add(key + ('halving',))
+        if stopped_at_epoch is None:
+            completed_runs.add(key + ('grid',))
+    return completed_runs
+
+def record_rung(bracket, signature, epoch, metric, path=REPORT_DB):
+    # Saves the metric of a configuration at a rung and returns the metrics of all the configurations at that rung
+    connection = connect_report(path)
+    with connection:
+        connection.execute('INSERT OR REPLACE INTO rungs (bracket, signature, epoch, metric) VALUES (?, ?, ?, ?)',
+                           (bracket, signature, epoch, metric))
+        metrics = [metric for (metric,) in connection.execute('SELECT metric FROM rungs WHERE bracket = ? AND epoch = ?', (bracket, epoch))]
+    connection.close()
+    return metrics
+
+def import_legacy_report(connection, json_path=LEGACY_REPORT_JSON):
+    # Copy the runs of an old report.json into a new ledger, in a single transaction. BEGIN IMMEDIATE and the
+    # count make it safe when several processes create the ledger at the same time
+    if not os.path.exists(json_path):
+        return 0
+    rows = json.load(open(json_path))
+    connection.execute('BEGIN IMMEDIATE')
+    try:
+        (count,) = connection.execute('SELECT COUNT(*) FROM runs').fetchone()
+        if count == 0:
+            for row in rows:
+                insert_run(connection, row)
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    if count > 0:
+        return 0
+    print(f"Imported {len(rows)} runs from {json_path} into the run ledger.")
+    return len(rows)
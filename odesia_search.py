@@ -0,0 +1,62 @@
+import json
+import math
+from transformers import TrainerCallback
+from odesia_report import record_rung
+
+# Successive halving: every configuration is evaluated on val at the end of some epochs (rungs) and only
+# the best 1/REDUCTION_FACTOR of the configurations that reached that rung keep training
+REDUCTION_FACTOR = 3
+MIN_EPOCHS = 1
+
+def halving_rungs(num_train_epochs, reduction_factor=REDUCTION_FACTOR, min_epochs=MIN_EPOCHS):
+    # con 5 epochs y factor 3 las paradas son en los epochs 1 y 3
+    rungs = []
+    epoch = min_epochs
+    while epoch < num_train_epochs:
+        rungs.append(epoch)
+        epoch *= reduction_factor
+    return rungs
+
+class SuccessiveHalvingCallback(TrainerCallback):
+    """
+    Asynchronous successive halving. The decision is taken as soon as a configuration reaches a rung, comparing
+    it with the configurations that reached it before (in this or in other processes, through the run ledger),
+    so the first configurations always continue and the grid can be trained in any order or in parallel.
+    """
+    def __init__(self, bracket, signature, main_metric, rungs, reduction_factor=REDUCTION_FACTOR):
+        self.bracket = bracket
+        self.signature = signature
+        self.main_metric = main_metric
+        self.rungs = rungs
+        self.reduction_factor = reduction_factor
+        self.stopped_at_epoch = None
+
+    def on_epoch_end(self, args, state, control, **kwargs):
+        # solo se evalúa en los epochs de las paradas
+        if round(state.epoch) in self.rungs:
+            control.should_evaluate = True
+
+    def on_evaluate(self, args, state, control, metrics=None, **kwargs):
+        epoch = round(state.epoch)
+        if epoch not in self.rungs or self.main_metric not in metrics:
+            return
+        metric = float(metrics[self.main_metric])
+        rung_metrics = record_rung(self.bracket, self.signature, epoch, metric)
+        better = sum(rung_metric > metric for rung_metric in rung_metrics)
+        if better >= max(1, math.ceil(len(rung_metrics) / self.reduction_factor)):
+            print(f">>>> Successive halving: stopping at epoch {epoch} ({self.main_metric}={metric:.4f}, {better} of {len(rung_metrics)} configurations are better)")
+            self.stopped_at_epoch = epoch
+            control.should_training_stop = True
+
+def enable_successive_halving(odesia_model, bracket, signature, main_metric):
+    # Only the models trained with a HF Trainer that computes the main metric can stop early,
+    # the rest (question answering, sentence similarity) train the full number of epochs
+    trainer = getattr(odesia_model, 'trainer', None)
+    if trainer is None or trainer.compute_metrics is None:
+        return None
+    callback = SuccessiveHalvingCallback(bracket=json.dumps(bracket),
+                                         signature=json.dumps(signature),
+                                         main_metric=main_metric,
+                                         rungs=halving_rungs(trainer.args.num_train_epochs))
+    trainer.add_callback(callback)
+    return callback
@@ -1,23 +1,27 @@
 from torch.utils.data import DataLoader
-from sentence_transformers import SentenceTransformer, losses, util, InputExample
+from sentence_transformers import SentenceTransformer, losses, InputExample
 from sentence_transformers.evaluation import EmbeddingSimilarityEvaluator
+from sklearn.metrics.pairwise import paired_cosine_distances, paired_euclidean_distances, paired_manhattan_distances
+from scipy.stats import pearsonr, spearmanr
 import math
-import pandas as pd
+import os
+import numpy as np
 from odesia_core import OdesiaHFModel
 from odesia_utils import keep_keys
 
 
 class OdesiaSentenceSimilarity(OdesiaHFModel):
+    encode_batch_size = 128
     
-    def __init__(self, model_path, dataset_path, model_config, dataset_config):                
-        super().__init__(model_path, dataset_path, model_config, dataset_config)
+    def __init__(self, model_path, dataset_path, model_config, dataset_config, session=None):                
+        super().__init__(model_path, dataset_path, model_config, dataset_config, session)
                 
         # Step 2. Tokenized the dataset            
         self.max_score = self.dataset_config["max_score"]
         self.tokenized_dataset = self.preprocess_function(self.dataset, 
                                                          self.max_score)#, batched=True, remove_columns=self.dataset["train"].column_names)
         # Step 3. Loading model, trainer and metrics     
-        self.model = SentenceTransformer(model_path)
+        self.model = self.load_model(lambda: SentenceTransformer(model_path))
         self.train_dataloader = DataLoader(self.tokenized_dataset['train'], shuffle=True, batch_size=self.model_config['hf_parameters']['per_device_train_batch_size'])
         self.train_loss = losses.CosineSimilarityLoss(model=self.model)
         self.evaluator = EmbeddingSimilarityEvaluator.from_input_examples(self.tokenized_dataset['val'])
@@ -33,6 +37,9 @@ class OdesiaSentenceSimilarity(OdesiaHFModel):
         # Eliminamos todas las claves menos las que queremos usar en SenteceTransformers
         self.model_config['hf_parameters'] = keep_keys(dictionary=self.model_config['hf_parameters'], 
                   keys_to_keep=['optimizer_params', 'epochs', 'warmup_steps', 'weight_decay'])
+
+        # Embeddings of the unique sentences of each split, shared by evaluate() and predict()
+        self.embeddings = {}
         
     
     def preprocess_function(self, dataset, max_score=5.0):         
@@ -46,44 +53,71 @@ class OdesiaSentenceSimilarity(OdesiaHFModel):
         return tokenized_dataset
     
     def train(self):
+        # the embeddings of a previous model are no longer valid
+        self.embeddings = {}
+        for split in self.dataset:
+            if os.path.isfile(self.embeddings_path(split)):
+                os.remove(self.embeddings_path(split))
         self.model.fit(train_objectives=[(self.train_dataloader, self.train_loss)],
               evaluator=self.evaluator,
               output_path = f"{self.output_dir}/model",
               **self.model_config['hf_parameters'])
+
+    def embeddings_path(self, split):
+        return f"{self.output_dir}/embeddings_{split}.npz"
+
+    def encode_split(self, split):
+        # Each unique sentence of the split is encoded once, in batches, and cached in memory and on disk
+        if split not in self.embeddings:
+            path = self.embeddings_path(split)
+            if os.path.isfile(path):
+                cached = np.load(path)
+                sentences, embeddings = cached['sentences'].tolist(), cached['embeddings']
+            else:
+                sentences = list(dict.fromkeys(self.dataset[split]['sentence1'] + self.dataset[split]['sentence2']))
+                embeddings = self.model.encode(sentences, batch_size=self.encode_batch_size, convert_to_numpy=True)
+                np.savez(path, sentences=np.array(sentences), embeddings=embeddings)
+            self.embeddings[split] = (sentences, np.ascontiguousarray(embeddings))
+        return self.embeddings[split]
+
+    def pair_embeddings(self, split):
+        sentences, embeddings = self.encode_split(split)
+        sentence_index = {sentence: i for i, sentence in enumerate(sentences)}
+        embeddings1 = embeddings[[sentence_index[sentence] for sentence in self.dataset[split]['sentence1']]]
+        embeddings2 = embeddings[[sentence_index[sentence] for sentence in self.dataset[split]['sentence2']]]
+        return embeddings1, embeddings2
     
     def evaluate(self, split="val"):
-        output_path = f"{self.output_dir}/model/"
-        test_evaluator = EmbeddingSimilarityEvaluator.from_input_examples(self.tokenized_dataset[split], name=split)
-        # generamos los resultados
-        test_evaluator_call = test_evaluator(self.model, output_path=output_path)
+        # Same metrics as EmbeddingSimilarityEvaluator, computed from the cached embeddings
+        embeddings1, embeddings2 = self.pair_embeddings(split)
+        labels = [example.label for example in self.tokenized_dataset[split]]
+
+        cosine_scores = 1 - (paired_cosine_distances(embeddings1, embeddings2))
+        manhattan_distances = -paired_manhattan_distances(embeddings1, embeddings2)
+        euclidean_distances = -paired_euclidean_distances(embeddings1, embeddings2)
+        dot_products = np.einsum('ij,ij->i', embeddings1, embeddings2)
 
-        # por alguna extraña razón sentence transformers no devuelve las similitudes en variables sino que las guarda en un csv
-        csv_results = pd.read_csv(f"{output_path}/similarity_evaluation_{split}_results.csv")
-        results = csv_results.to_dict('records')[0]
+        results = {'epoch': -1, 'steps': -1}
+        with self.timer.phase('metrics'):
+            for name, scores in [('cosine', cosine_scores), ('euclidean', euclidean_distances), 
+                                 ('manhattan', manhattan_distances), ('dot', dot_products)]:
+                results[f'{name}_pearson'] = float(pearsonr(labels, scores)[0])
+                results[f'{name}_spearman'] = float(spearmanr(labels, scores)[0])
         return results
     
     def predict(self, split="test"):
-        examples = self.tokenized_dataset[split]
-        examples_originals = self.dataset[split]
-        predictions = []
-        for example, example_original in zip(examples, examples_originals):
-            text1, text2 = example.texts
-            
-            # Obtener las incrustaciones (embeddings) para los textos
-            embedding1 = self.model.encode(text1, convert_to_tensor=True)
-            embedding2 = self.model.encode(text2, convert_to_tensor=True)
+        embeddings1, embeddings2 = self.pair_embeddings(split)
 
-            # Calcular la puntuación de similitud utilizando el coseno de los embeddings
-            similarity_score = util.pytorch_cos_sim(embedding1, embedding2).item()
-            
-            # Imprimir o almacenar la similitud según sea necesario
+        # Similitud coseno de todos los pares a la vez, normalizando como util.pytorch_cos_sim
+        norms1 = np.maximum(np.linalg.norm(embeddings1, axis=1), 1e-12)
+        norms2 = np.maximum(np.linalg.norm(embeddings2, axis=1), 1e-12)
+        similarity_scores = np.einsum('ij,ij->i', embeddings1, embeddings2) / (norms1 * norms2)
+
+        predictions = []
+        for similarity_score, example_id in zip(similarity_scores.tolist(), self.dataset[split]['id']):
             predictions.append({
-                            #"sentence1": text1,
-                            #"sentence2": text2,                            
                             "similarity_score": similarity_score*self.max_score,
                             "test_case":self.test_case,
-                            'id': int(example_original['id'])
+                            'id': int(example_id)
                         })
-            # Agregar la similitud como una nueva propiedad a los ejemplos si lo deseas
-            # example.similarity = similarity_score
-        return predictions 
\ No newline at end of file
+        return predictions 
@@ -0,0 +1,47 @@
+import resource
+import sys
+import time
+from contextlib import contextmanager
+
+def cuda_available():
+    # torch no se importa aquí: si ningún módulo lo ha importado todavía, tampoco hay nada en la GPU
+    torch = sys.modules.get('torch')
+    return torch is not None and torch.cuda.is_available()
+
+class PhaseTimer:
+    """
+    Wall time, CPU time and memory of each phase of a grid point. A phase that runs several times
+    (e.g. the metrics of every evaluation) accumulates its times.
+    """
+    def __init__(self):
+        self.phases = {}
+        self.active_phases = 0
+
+    @contextmanager
+    def phase(self, name):
+        # el pico de memoria del dispositivo solo se reinicia en las fases exteriores, no en las anidadas (metrics)
+        if cuda_available() and self.active_phases == 0:
+            sys.modules['torch'].cuda.reset_peak_memory_stats()
+        self.active_phases += 1
+        start_wall = time.perf_counter()
+        start_cpu = time.process_time()
+        try:
+            yield
+        finally:
+            self.active_phases -= 1
+            record = self.phases.setdefault(name, {'wall_time': 0.0, 'cpu_time': 0.0, 'calls': 0})
+            record['wall_time'] += time.perf_counter() - start_wall
+            record['cpu_time'] += time.process_time() - start_cpu
+            record['calls'] += 1
+            # pico de memoria residente del proceso desde que arrancó hasta el final de la fase, no el de la fase:
+            # ru_maxrss no se puede reiniciar (está en KB en Linux y en bytes en macOS)
+            max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            record['process_peak_rss_mb'] = max_rss / (2**20 if sys.platform == 'darwin' else 2**10)
+            if cuda_available():
+                record['peak_device_memory_mb'] = max(record.get('peak_device_memory_mb', 0.0), sys.modules['torch'].cuda.max_memory_allocated() / 2**20)
+
+    def set_throughput(self, name, samples):
+        # muestras por segundo de una fase ya medida
+        record = self.phases[name]
+        record['samples'] = samples
+        record['samples_per_second'] = samples / record['wall_time'] if record['wall_time'] > 0 else None
@@ -1,11 +1,16 @@
 import os
 from itertools import product
-import jsbeautifier
+import gzip
 import json
 import glob
-import pandas as pd
 import numpy as np
 
+# orjson es opcional: si está instalado, serializa (incluidos los arrays de numpy) mucho más rápido
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 def create_directories(path):
     try:
         # Create all directories in the path
@@ -47,21 +52,76 @@ def compose_output_dir(dataset_name, model, hparams, language):
         output_dir += f"_{param}_{value}"
     return output_dir
     
+def hparams_signature(hf_parameters):
+    # firma canónica de los hiperparámetros: dos entrenamientos con el mismo batch efectivo
+    # (per_device_train_batch_size * gradient_accumulation_steps) son equivalentes
+    hf_parameters = dict(hf_parameters)
+    batch_size = hf_parameters.pop('per_device_train_batch_size', 8)
+    gradient_accumulation_steps = hf_parameters.pop('gradient_accumulation_steps', 1)
+    hf_parameters['effective_batch_size'] = batch_size * gradient_accumulation_steps
+    return tuple(sorted((param, str(value)) for param, value in hf_parameters.items()))
+
 def compose_dataset_path(dataset, language):
     dataset_path = {}
     for split in ['train', 'test', 'val']:
         dataset_path[split] = f'datasets/{dataset}/{split}_{language}.json'
     return dataset_path
 
-class NumpyFloatValuesEncoder(json.JSONEncoder):
+class NumpyValuesEncoder(json.JSONEncoder):
     def default(self, obj):
-        if isinstance(obj, np.float32):
+        if isinstance(obj, np.integer):
+            return int(obj)
+        if isinstance(obj, np.floating):
             return float(obj)
+        if isinstance(obj, np.bool_):
+            return bool(obj)
+        if isinstance(obj, np.ndarray):
+            return obj.tolist()
         return json.JSONEncoder.default(self, obj)
 
-def save_json(path, data):
-    with open(path, 'w', encoding='utf8') as fp:
-        fp.write(jsbeautifier.beautify(json.dumps(data, cls=NumpyFloatValuesEncoder, ensure_ascii=False)))
+# nombre anterior, solo cubría np.float32
+NumpyFloatValuesEncoder = NumpyValuesEncoder
+
+def all_finite(data):
+    # orjson escribe NaN e infinito como null; json los escribe como NaN/Infinity, que es lo que se ha guardado siempre
+    if isinstance(data, dict):
+        return all(all_finite(value) for value in data.values())
+    if isinstance(data, (list, tuple)):
+        return all(all_finite(value) for value in data)
+    if isinstance(data, np.ndarray):
+        return not np.issubdtype(data.dtype, np.inexact) or bool(np.isfinite(data).all())
+    if isinstance(data, (float, np.floating)):
+        return bool(np.isfinite(data))
+    return True
+
+def use_orjson(data, indent):
+    # orjson solo sabe indentar con 2 espacios, y solo se usa si no cambia la salida
+    return orjson is not None and indent in (None, 2) and all_finite(data)
+
+def dumps_json(data, indent=None):
+    if use_orjson(data, indent):
+        option = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(data, option=option, default=NumpyValuesEncoder().default).decode('utf8')
+    return json.dumps(data, cls=NumpyValuesEncoder, ensure_ascii=False, indent=indent)
+
+def save_json(path, data, indent=2, jsonl=False):
+    """
+    Writes data as indented JSON, or as one JSON record per line if jsonl=True (data can then be any iterable,
+    e.g. a generator of predictions). The file is gzip-compressed when path ends with .gz.
+    """
+    open_file = gzip.open if path.endswith('.gz') else open
+    with open_file(path, 'wt', encoding='utf8') as fp:
+        if jsonl:
+            for record in data:
+                fp.write(dumps_json(record))
+                fp.write('\n')
+        elif use_orjson(data, indent):
+            fp.write(dumps_json(data, indent=indent))
+        else:
+            # json.dump escribe por trozos, sin construir el documento entero en memoria
+            json.dump(data, fp, cls=NumpyValuesEncoder, ensure_ascii=False, indent=indent)
 
 def keep_keys(dictionary, keys_to_keep):
     # Create a copy of the original dictionary to avoid modifying it directly
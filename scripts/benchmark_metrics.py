@@ -0,0 +1,231 @@
+import argparse
+import copy
+import datetime
+import gc
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+
+# Get the directory containing this script
+script_directory = os.path.dirname(os.path.abspath(__file__))
+# Get the parent directory
+parent_directory = os.path.dirname(script_directory)
+# Add the parent directory to the system path
+sys.path.append(parent_directory)
+
+from vendor.exist2023evaluation import (ICM_Hard, ICM_Hard_Vectorized, ICM_Soft, ICM_Soft_Vectorized, FMeasure, FMeasure_Vectorized,
+                                        EXIST_2023_evaluation, MONO_LABEL_TASK, MULTI_LABEL_TASK, ID, VALUE)
+from odesia_utils import save_json
+
+'''
+Micro-benchmark of the metric implementations (ICM hard/soft, FMeasure, seqeval) over synthetic EXIST 2023
+data. For each metric, implementation, task and size it stores the time, the peak of traced memory and the score
+in a JSON file, so the results of two versions can be compared with --compare.
+
+    python scripts/benchmark_metrics.py --sizes 1000 10000 100000 1000000 --output metrics_benchmark.json
+'''
+
+# tarea -> (tipo de tarea, jerarquía, clases hoja que pueden aparecer en las etiquetas)
+TASKS = {
+    't1': (MONO_LABEL_TASK, EXIST_2023_evaluation.TASK_1_HIERARCHY, ['YES', 'NO']),
+    't2': (MONO_LABEL_TASK, EXIST_2023_evaluation.TASK_2_HIERARCHY, ['NO'] + EXIST_2023_evaluation.TASK_2_HIERARCHY['YES']),
+    't3': (MULTI_LABEL_TASK, EXIST_2023_evaluation.TASK_3_HIERARCHY, ['NO'] + EXIST_2023_evaluation.TASK_3_HIERARCHY['YES']),
+}
+ANNOTATORS = 6
+NER_LABELS = ['O', 'B-PER', 'I-PER', 'B-LOC', 'I-LOC', 'B-ORG', 'I-ORG']
+SENTENCE_LENGTH = 14
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--sizes', type=int, nargs='+', default=[1000, 10000, 100000, 1000000], help='Number of items of each run')
+    parser.add_argument('-t', '--tasks', nargs='+', default=list(TASKS), help='EXIST 2023 tasks to benchmark')
+    parser.add_argument('-m', '--metrics', nargs='+', default=None, help='Only these metrics (e.g. ICM_Hard FMeasure)')
+    parser.add_argument('-b', '--budget', type=float, default=30.0, help='Seconds after which an implementation is not run with larger sizes')
+    parser.add_argument('-r', '--repeat', type=int, default=1, help='Timed runs per measure, the minimum is reported')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic data')
+    parser.add_argument('-o', '--output', type=str, default='metrics_benchmark.json', help='Path to the output JSON')
+    parser.add_argument('-c', '--compare', type=str, default=None, help='Previous output JSON to compare with')
+    return parser.parse_args()
+
+def generate_hard(task, size, rng, noise=0.3):
+    # Gold con etiquetas aleatorias y predicción igual al gold salvo en un `noise` de los items
+    task_type, _, leaves = TASKS[task]
+    ids = np.char.add('id', np.arange(size).astype(str))
+    if task_type == MONO_LABEL_TASK:
+        gold = np.array(leaves, dtype=object)[rng.integers(len(leaves), size=size)]
+        pred = np.where(rng.random(size) < noise, np.array(leaves, dtype=object)[rng.integers(len(leaves), size=size)], gold)
+    else:
+        gold = random_label_sets(leaves, size, rng)
+        pred = np.where(rng.random(size) < noise, random_label_sets(leaves, size, rng), gold)
+    return frame(ids, pred), frame(ids, gold)
+
+def random_label_sets(leaves, size, rng):
+    # 'NO' solo, o un subconjunto no vacío de las subclases de 'YES'
+    subclasses = np.array(leaves[1:], dtype=object)
+    masks = rng.random((size, len(subclasses))) < 0.3
+    masks[np.arange(size), rng.integers(len(subclasses), size=size)] = True
+    is_no = rng.random(size) < 0.4
+    sets = np.empty(size, dtype=object)
+    sets[:] = [['NO'] if no else subclasses[mask].tolist() for no, mask in zip(is_no, masks)]
+    return sets
+
+def generate_soft(task, size, rng, noise=0.2):
+    # Gold soft a partir de los votos de ANNOTATORS anotadores, predicción soft = gold con ruido
+    task_type, _, leaves = TASKS[task]
+    ids = np.char.add('id', np.arange(size).astype(str))
+    if task_type == MONO_LABEL_TASK:
+        votes = rng.multinomial(ANNOTATORS, np.full(len(leaves), 1 / len(leaves)), size=size)
+        gold = votes / ANNOTATORS
+        pred = np.clip(gold + rng.normal(0, noise, gold.shape), 1e-3, None)
+        pred = pred / pred.sum(axis=1, keepdims=True)
+    else:
+        votes = np.zeros((size, len(leaves)))
+        for _ in range(ANNOTATORS):
+            annotator_sets = random_label_sets(leaves, size, rng)
+            for j, leaf in enumerate(leaves):
+                votes[:, j] += [leaf in labels for labels in annotator_sets]
+        gold = votes / ANNOTATORS
+        pred = np.clip(gold + rng.normal(0, noise, gold.shape), 0, 1)
+    return frame(ids, soft_dicts(leaves, pred)), frame(ids, soft_dicts(leaves, gold))
+
+def soft_dicts(leaves, probabilities):
+    dicts = np.empty(len(probabilities), dtype=object)
+    dicts[:] = [dict(zip(leaves, row)) for row in probabilities.tolist()]
+    return dicts
+
+def generate_sequences(size, rng, noise=0.1):
+    # size frases de SENTENCE_LENGTH tokens con etiquetas BIO
+    gold = np.array(NER_LABELS, dtype=object)[rng.integers(len(NER_LABELS), size=(size, SENTENCE_LENGTH))]
+    pred = np.where(rng.random(gold.shape) < noise, np.array(NER_LABELS, dtype=object)[rng.integers(len(NER_LABELS), size=gold.shape)], gold)
+    return pred.tolist(), gold.tolist()
+
+def frame(ids, values):
+    return pd.DataFrame({ID: ids, VALUE: values})
+
+def icm_runner(metric_class, cached=False):
+    def prepare(pred_df, gold_df, task_type, hierarchy):
+        gold_statistics = None
+        if cached:
+            # estadísticas del gold calculadas antes de medir, como en la caché de odesia_cache
+            gold_statistics = metric_class(pred_df, gold_df, task_type, copy.deepcopy(hierarchy)).get_gold_statistics()
+        def run():
+            if cached:
+                return metric_class(pred_df, gold_df, task_type, copy.deepcopy(hierarchy), gold_statistics=gold_statistics).evaluate()
+            return metric_class(pred_df, gold_df, task_type, copy.deepcopy(hierarchy)).evaluate()
+        return run
+    return prepare
+
+def fmeasure_runner(metric_class):
+    def prepare(pred_df, gold_df, task_type, hierarchy):
+        return lambda: float(metric_class(pred_df, gold_df, task_type).evaluate()['macro-F'])
+    return prepare
+
+def seqeval_runner():
+    def prepare(predictions, references, task_type, hierarchy):
+        from seqeval.metrics import classification_report
+        return lambda: float(classification_report(references, predictions, output_dict=True)['micro avg']['f1-score'])
+    return prepare
+
+# (métrica, implementación, datos, preparación)
+BENCHMARKS = [
+    ('ICM_Hard', 'ICM_Hard', 'hard', icm_runner(ICM_Hard)),
+    ('ICM_Hard', 'ICM_Hard_Vectorized', 'hard', icm_runner(ICM_Hard_Vectorized)),
+    ('ICM_Hard', 'ICM_Hard_Vectorized (cached gold)', 'hard', icm_runner(ICM_Hard_Vectorized, cached=True)),
+    ('ICM_Soft', 'ICM_Soft', 'soft', icm_runner(ICM_Soft)),
+    ('ICM_Soft', 'ICM_Soft_Vectorized', 'soft', icm_runner(ICM_Soft_Vectorized)),
+    ('ICM_Soft', 'ICM_Soft_Vectorized (cached gold)', 'soft', icm_runner(ICM_Soft_Vectorized, cached=True)),
+    ('FMeasure', 'FMeasure', 'hard', fmeasure_runner(FMeasure)),
+    ('FMeasure', 'FMeasure_Vectorized', 'hard', fmeasure_runner(FMeasure_Vectorized)),
+    ('seqeval', 'seqeval', 'sequences', seqeval_runner()),
+]
+
+def measure(run, repeat):
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        score = run()
+        times.append(time.perf_counter() - start)
+    # la memoria se mide en otra ejecución, porque tracemalloc ralentiza el código Python
+    gc.collect()
+    tracemalloc.start()
+    run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return min(times), peak / 2**20, score
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=parent_directory, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmarks(args):
+    results = []
+    benchmarks = [benchmark for benchmark in BENCHMARKS if args.metrics is None or benchmark[0] in args.metrics]
+    for metric, implementation, data, prepare in benchmarks:
+        # seqeval no depende de la tarea de EXIST
+        tasks = ['ner'] if data == 'sequences' else args.tasks
+        for task in tasks:
+            for size in sorted(args.sizes):
+                rng = np.random.default_rng(args.seed)
+                if data == 'hard':
+                    pred, gold = generate_hard(task, size, rng)
+                elif data == 'soft':
+                    pred, gold = generate_soft(task, size, rng)
+                else:
+                    pred, gold = generate_sequences(size, rng)
+                task_type, hierarchy, _ = TASKS.get(task, (None, None, None))
+                try:
+                    run = prepare(pred, gold, task_type, hierarchy)
+                    elapsed, peak_memory, score = measure(run, args.repeat)
+                except ImportError as e:
+                    print(f"Skipping {implementation}: {e}")
+                    break
+                results.append({'metric': metric, 'implementation': implementation, 'task': task, 'size': size,
+                                'time': elapsed, 'peak_memory_mb': peak_memory, 'score': float(score)})
+                print(f"{metric:10} {implementation:36} {task:4} {size:>9} items: {elapsed:10.4f} s {peak_memory:10.1f} MB  score={float(score):.6f}")
+                # las siguientes tallas tardarían todavía más
+                if elapsed > args.budget:
+                    print(f"{implementation} took more than {args.budget} s, larger sizes are skipped")
+                    break
+    return results
+
+def compare(results, previous_path):
+    with open(previous_path) as f:
+        previous = {(r['metric'], r['implementation'], r['task'], r['size']): r for r in json.load(f)['results']}
+    print(f"\nComparison with {previous_path} (ratio > 1 means slower now):")
+    for result in results:
+        key = (result['metric'], result['implementation'], result['task'], result['size'])
+        if key in previous:
+            ratio = result['time'] / previous[key]['time'] if previous[key]['time'] > 0 else float('inf')
+            same_score = np.isclose(result['score'], previous[key]['score'])
+            print(f"{key[0]:10} {key[1]:36} {key[2]:4} {key[3]:>9} items: x{ratio:6.2f}{'' if same_score else '  SCORE CHANGED'}")
+
+def main():
+    args = parse_arguments()
+    results = run_benchmarks(args)
+    report = {
+        'commit': git_commit(),
+        'date': str(datetime.datetime.now()),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'seed': args.seed,
+        'repeat': args.repeat,
+        'results': results,
+    }
+    save_json(args.output, report)
+    print(f"Results saved in {args.output}")
+    if args.compare:
+        compare(results, args.compare)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+import argparse
+import os
+import re
+import subprocess
+import sys
+import time
+
+# Get the directory containing this script
+script_directory = os.path.dirname(os.path.abspath(__file__))
+# Get the parent directory
+parent_directory = os.path.dirname(script_directory)
+# Add the parent directory to the system path
+sys.path.append(parent_directory)
+
+from odesia_evaluate_model import TASK_REGISTRY
+from odesia_utils import save_json
+
+'''
+Import time of the CLI and of the worker processes, measured in fresh interpreters. The CLI and the workers must
+start within --budget seconds (the script exits with code 1 otherwise); the import of each task module, which
+brings torch, transformers, etc., is reported without budget because it is only paid by the datasets of that type.
+
+    python scripts/benchmark_startup.py --budget 1.0 --output startup_benchmark.json
+'''
+
+# nombre -> código que ejecuta el intérprete nuevo
+STARTUP_TARGETS = {
+    # python main.py, sin llegar a entrenar
+    'cli': 'import main',
+    # un proceso trabajador 'spawn' importa el __main__ del padre y el módulo de train_grid_point
+    'worker': 'import main, odesia_evaluate_model',
+}
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-b', '--budget', type=float, default=1.0, help='Maximum seconds to start the CLI and a worker')
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='Runs per measure, the minimum is reported')
+    parser.add_argument('-n', '--top', type=int, default=10, help='Slowest imports to show of each target')
+    parser.add_argument('-o', '--output', type=str, default=None, help='Path to the output JSON')
+    return parser.parse_args()
+
+def run_python(code, importtime=False):
+    command = [sys.executable] + (['-X', 'importtime'] if importtime else []) + ['-c', code]
+    start = time.perf_counter()
+    process = subprocess.run(command, cwd=parent_directory, capture_output=True, text=True)
+    return time.perf_counter() - start, process
+
+def slowest_imports(stderr, top):
+    # líneas de -X importtime: "import time: self [us] | cumulative | imported package". Se agrupan por paquete
+    # de primer nivel, con el mayor tiempo acumulado de sus módulos
+    packages = {}
+    for line in stderr.splitlines():
+        match = re.match(r'import time:\s+(\d+) \|\s+(\d+) \|\s*(\S+)', line)
+        if match:
+            package = match.group(3).split('.')[0]
+            packages[package] = max(packages.get(package, 0.0), int(match.group(2)) / 1e6)
+    return sorted(((seconds, package) for package, seconds in packages.items()), reverse=True)[:top]
+
+def measure(code, repeat, top):
+    baseline = min(run_python('pass')[0] for _ in range(repeat))
+    times = []
+    for _ in range(repeat):
+        elapsed, process = run_python(code)
+        if process.returncode != 0:
+            return {'error': process.stderr.strip().splitlines()[-1]}
+        times.append(elapsed)
+    _, process = run_python(code, importtime=True)
+    # el arranque del intérprete no depende del proyecto
+    return {'time': min(times) - baseline, 'interpreter_time': baseline, 'slowest_imports': slowest_imports(process.stderr, top)}
+
+def main():
+    args = parse_arguments()
+    results = {}
+    over_budget = []
+    for name, code in STARTUP_TARGETS.items():
+        results[name] = measure(code, args.repeat, args.top)
+        if 'error' in results[name]:
+            print(f"{name:30} failed: {results[name]['error']}")
+            over_budget.append(name)
+            continue
+        print(f"{name:30} {results[name]['time']:8.3f} s (budget {args.budget} s)")
+        for seconds, module in results[name]['slowest_imports']:
+            print(f"    {seconds:8.3f} s  {module}")
+        if results[name]['time'] > args.budget:
+            over_budget.append(name)
+
+    for module in sorted({module for module, _, _ in TASK_REGISTRY.values()}):
+        result = measure(f'import {module}', args.repeat, args.top)
+        results[module] = result
+        if 'error' in result:
+            print(f"{module:30} failed: {result['error']}")
+        else:
+            print(f"{module:30} {result['time']:8.3f} s (paid by the first dataset of this type)")
+
+    if args.output:
+        save_json(args.output, {'budget': args.budget, 'python': sys.version, 'results': results})
+        print(f"Results saved in {args.output}")
+    if over_budget:
+        print(f"Over the startup budget: {', '.join(over_budget)}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -20,11 +20,15 @@ fi
 # For each folder in datasets directory, remove all folders starting with "tokenized_"
 for folder in datasets/*; do
   if [ -d "$folder" ]; then
-    # Remove all folders starting with "tokenized_"
+    # Remove all folders starting with "tokenized_" and the cached gold statistics
     rm -rf $folder/tokenized_*
+    rm -rf $folder/icm_gold_statistics
   fi
 done
 
+# Remove the tokenization cache
+rm -rf tokenization_cache
+
 # Remove report.json
-rm -rf report.json
+rm -rf report.json report.db report.db-wal report.db-shm
 